@@ -0,0 +1,108 @@
+'''Iterations per second and final loss of the recover optimization in fp32, fp16 / bf16 autocast and channels_last'''
+
+import os
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torchvision import transforms
+
+from utils import *
+import models as ti_models
+
+"""
+python benchmark_amp.py --arch ResNet18 --pre-train-path ../squeeze/squeeze_wo_ema/ --iteration 200
+"""
+
+
+def run(args, model, mode, channels_last, device):
+    amp_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(mode)
+    model = model.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+    loss_accumulator = FeatureLossAccumulator(device)
+    hooks = [BNFeatureHook(module) for module in model.modules() if isinstance(module, nn.BatchNorm2d)]
+    for idx, hook in enumerate(hooks):
+        hook.accumulator = loss_accumulator
+        hook.loss_weight = args.first_multiplier if idx == 0 else 1.
+
+    # the same images, targets and crops for every mode
+    torch.manual_seed(0)
+    targets = torch.arange(10).repeat(args.batch_size // 10).to(device)
+    inputs = torch.randn((targets.shape[0], 3, 32, 32), requires_grad=True, device=device)
+    optimizer = optim.Adam([inputs], lr=args.lr, betas=[0.5, 0.9], eps=1e-8)
+    lr_scheduler = lr_cosine_policy(args.lr, 0, args.iteration)
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+    aug_function = transforms.Compose([
+        transforms.RandomCrop(32, padding=4),
+        transforms.RandomHorizontalFlip(),
+    ])
+    criterion = nn.CrossEntropyLoss()
+
+    start = None
+    for iteration in range(args.iteration + args.warmup):
+        if iteration == args.warmup:
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        lr_scheduler(optimizer, max(iteration - args.warmup, 0), max(iteration - args.warmup, 0))
+        optimizer.zero_grad()
+        loss_accumulator.reset()
+        outputs = teacher_forward(model, aug_function(inputs), amp_dtype, channels_last)
+        loss = criterion(outputs, targets) + args.r_loss * loss_accumulator.value
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        inputs.data = clip(inputs.data)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    # the final loss is evaluated in fp32 on the un-augmented images
+    loss_accumulator.reset()
+    outputs = model(inputs.detach())
+    final_loss = (criterion(outputs, targets) + args.r_loss * loss_accumulator.value).item()
+    for hook in hooks:
+        hook.close()
+    return args.iteration / elapsed, final_loss
+
+
+def main():
+    parser = argparse.ArgumentParser("Benchmark low-precision synthesis on a CIFAR-10 teacher")
+    parser.add_argument('--arch', type=str, default='ResNet18')
+    parser.add_argument('--pre-train-path', type=str, default='../squeeze/squeeze_wo_ema/',
+                        help='squeezed teachers, a randomly initialized one is used if the checkpoint is missing')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--iteration', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--lr', type=float, default=0.05)
+    parser.add_argument('--r-loss', type=float, default=0.01)
+    parser.add_argument('--first-multiplier', type=float, default=10.)
+    parser.add_argument('--cpu', action='store_true', default=False)
+    args = parser.parse_args()
+
+    device = torch.device("cpu" if args.cpu or not torch.cuda.is_available() else "cuda")
+    model = ti_models.model_dict[args.arch](num_classes=10)
+    checkpoint_path = os.path.join(args.pre_train_path, "CIFAR-10", args.arch, f"squeeze_{args.arch}.pth")
+    if os.path.exists(checkpoint_path):
+        model.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
+    else:
+        print(f"{checkpoint_path} not found, using a randomly initialized {args.arch}")
+    model = model.to(device).eval()
+    for p in model.parameters():
+        p.requires_grad = False
+
+    # autocast on CPU only supports bf16
+    modes = [("fp32", False), ("fp32", True), ("bf16", False), ("bf16", True)]
+    if device.type == "cuda":
+        modes += [("fp16", False), ("fp16", True)]
+    baseline = None
+    for mode, channels_last in modes:
+        speed, final_loss = run(args, model, mode, channels_last, device)
+        baseline = baseline or speed
+        print(f"{mode:>5} {'channels_last' if channels_last else 'contiguous':>14}  {speed:8.2f} it/s "
+              f"({speed / baseline:4.2f}x)  final loss {final_loss:.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -35,6 +35,9 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
 
     torch.cuda.set_device(args.gpu)
     model_teacher = [_model_teacher.cuda(gpu).eval() for _model_teacher in model_teacher]
+    if args.channels_last:
+        model_teacher = [_model_teacher.to(memory_format=torch.channels_last) for _model_teacher in model_teacher]
+    amp_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(args.amp)
 
     for _model_teacher in model_teacher:
         for p in _model_teacher.parameters():
@@ -50,6 +53,7 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
     best_cost = 1e4
 
     load_tag = True
+    load_tag_dict = [True for _ in range(len(model_teacher))]
     loss_r_feature_layers = [[] for _ in range(len(model_teacher))]
     for i, (_model_teacher) in enumerate(model_teacher):
         print(_model_teacher)
@@ -62,6 +66,7 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
                                                gpu=gpu, training_momentum=args.training_momentum, drop_rate=args.drop_rate)
                 _hook_module.set_hook(pre=True)
                 load_tag = load_tag & _hook_module.load_tag
+                load_tag_dict[i] = load_tag_dict[i] & _hook_module.load_tag
                 loss_r_feature_layers[i].append(_hook_module)
         print(load_tag)
 
@@ -84,28 +89,47 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
                                                    shuffle=True)
 
         with torch.no_grad():
-            for j, _model_teacher in enumerate(model_teacher):
+            if args.statistic_single_pass:
+                # decode every batch once and feed it to all backbones whose statistics are missing
+                missing_teacher = [j for j in range(len(model_teacher)) if not load_tag_dict[j]]
                 for i, (data, _) in tqdm(enumerate(train_loader)):
                     data = data.cuda(gpu)
-                    _ = _model_teacher(data)
-                print(f"Compute {_model_teacher}")
-                for _loss_t_feature_layer in loss_r_feature_layers[j]:
-                    if isinstance(_loss_t_feature_layer, ConvFeatureHook):
-                        _loss_t_feature_layer.save()
+                    for j in missing_teacher:
+                        _ = model_teacher[j](data)
+                for j in missing_teacher:
+                    print(f"Compute {model_teacher[j]}")
+                    for _loss_t_feature_layer in loss_r_feature_layers[j]:
+                        if isinstance(_loss_t_feature_layer, ConvFeatureHook):
+                            _loss_t_feature_layer.save()
+            else:
+                for j, _model_teacher in enumerate(model_teacher):
+                    if load_tag_dict[j]:
+                        continue
+                    for i, (data, _) in tqdm(enumerate(train_loader)):
+                        data = data.cuda(gpu)
+                        _ = _model_teacher(data)
+                    print(f"Compute {_model_teacher}")
+                    for _loss_t_feature_layer in loss_r_feature_layers[j]:
+                        if isinstance(_loss_t_feature_layer, ConvFeatureHook):
+                            _loss_t_feature_layer.save()
 
         print("Training Statistic Information Is Successfully Saved")
     else:
         print("Training Statistic Information Is Successfully Load")
 
+    # every hook adds its weighted r_feature into one device scalar, first layer scaled by first_multiplier
+    loss_accumulator = FeatureLossAccumulator(torch.device("cuda", gpu))
     for j in range(len(loss_r_feature_layers)):
-        for _loss_t_feature_layer in loss_r_feature_layers[j]:
+        for idx, _loss_t_feature_layer in enumerate(loss_r_feature_layers[j]):
             if isinstance(_loss_t_feature_layer, ConvFeatureHook):
                 _loss_t_feature_layer.set_hook(pre=False)
+            _loss_t_feature_layer.accumulator = loss_accumulator
+            _loss_t_feature_layer.loss_weight = args.first_multiplier if idx == 0 else 1.
 
     targets_all_all = torch.LongTensor(np.arange(100))[None, ...].expand(len(ipc_id_range), 100).contiguous().view(-1)
     ipc_id_all = torch.LongTensor(ipc_id_range)[..., None].expand(len(ipc_id_range), 100).contiguous().view(-1)
 
-    total_number = 100 * (ipc_id_range[-1] + 1 - ipc_id_range[0])
+    total_number = 100 * len(ipc_id_range)
     turn_index = torch.LongTensor(np.arange(total_number)).view(len(ipc_id_range), 100) \
         .transpose(1, 0).contiguous().view(-1)
 
@@ -129,6 +153,13 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
         lr_scheduler = lr_cosine_policy(args.lr, 0, iterations_per_layer)  # 0 - do not use warmup
         criterion = nn.CrossEntropyLoss()
         criterion = criterion.cuda()
+        # loss scaling only for fp16, disabled it passes the loss and the step through
+        scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+        sample_convergence = None
+        if args.freeze_threshold > 0:
+            sample_convergence = SampleConvergence(inputs, threshold=args.freeze_threshold, window=args.freeze_window)
+        # the per-sample feature terms are only summed up for the convergence tracking
+        loss_accumulator.track_samples(sub_batch_size if sample_convergence is not None else 0)
 
         for iteration in range(iterations_per_layer):
             # learning rate scheduling
@@ -149,14 +180,18 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
             optimizer.zero_grad()
             id = counter % len(model_teacher)
             counter += 1
-            sub_outputs = model_teacher[id](inputs_jit)
-            # R_cross classification loss
-            loss_ce = criterion(sub_outputs, targets)
+            loss_accumulator.reset()
+            sub_outputs = teacher_forward(model_teacher[id], inputs_jit, amp_dtype, args.channels_last)
+            if sample_convergence is not None:
+                # frozen samples stay in the forward, the batch moments seen by the hooks do not change
+                sample_loss_ce = F.cross_entropy(sub_outputs, targets, reduction="none")
+                loss_ce = sample_loss_ce.mean()
+            else:
+                # R_cross classification loss
+                loss_ce = criterion(sub_outputs, targets)
 
             # R_feature loss
-            rescale = [args.first_multiplier] + [1. for _ in range(len(loss_r_feature_layers[id]) - 1)]
-            loss_r_feature = sum(
-                [mod.r_feature * rescale[idx] for (idx, mod) in enumerate(loss_r_feature_layers[id])])
+            loss_r_feature = loss_accumulator.value
 
             # Nuclear losses
             adaptivepool = nn.AdaptiveAvgPool2d((32, 32))
@@ -167,18 +202,9 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
                 dist_inputs_jit = GatherLayer.apply(re_inputs_jit)
                 dist_inputs_jit = torch.cat(dist_inputs_jit, 0)
 
-            aux_nuc_norm_loss = 0.
             _targets = targets_all_all[
                 turn_index[zz: min(zz + ngpus_per_node * sub_batch_size, total_number)]].cuda(gpu).int()
-            set_targets = set(_targets.tolist())
-            for i in set_targets:
-                sub_class_inputs_jit = dist_inputs_jit[_targets == i]
-                sub_class_inputs_jit = sub_class_inputs_jit @ sub_class_inputs_jit.t()
-                l = torch.linalg.eigvals(sub_class_inputs_jit).real.float()
-                stu = l.log_softmax(dim=-1)
-                tea = (l / args.tau).softmax(dim=-1)
-                aux_nuc_norm_loss += nn.KLDivLoss(reduction="sum")(stu, tea.detach())
-            nuc_norm = aux_nuc_norm_loss
+            nuc_norm = nuclear_norm_loss(dist_inputs_jit, _targets, tau=args.tau)
 
             # nuc_norm = tr(S), where U^TSV = input_jit
 
@@ -200,12 +226,27 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
                     hook_for_display(inputs, targets)
 
             # do image update
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            if sample_convergence is not None:
+                sample_convergence.mask_grad(inputs)
+            scaler.step(optimizer)
+            scaler.update()
 
             # clip color outlayers
             inputs.data = clip(inputs.data)
 
+            if sample_convergence is not None:
+                sample_convergence.restore(inputs)
+                sample_loss = sample_loss_ce.detach() + args.r_loss * loss_accumulator.samples
+                if sample_convergence.update(sample_loss, iteration, inputs):
+                    done = torch.tensor([float(sample_convergence.all_frozen)], device=inputs.device)
+                    if zz + ngpus_per_node * sub_batch_size <= total_number:
+                        # ranks that all_gather have to stop together
+                        dist.all_reduce(done, op=dist.ReduceOp.MIN)
+                    if done.item() > 0:
+                        print(f"In GPU {gpu}, every sample is frozen after {iteration + 1} iterations")
+                        break
+
             if gpu == 0 and (best_cost > loss.item() or iteration == 1):
                 best_inputs = inputs.data.clone()
 
@@ -218,6 +259,11 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
             print("Testing...")
             hook_for_display(inputs, targets)
             save_images(args, best_inputs, targets, ipc_ids)
+        if sample_convergence is not None:
+            sample_convergence.save(os.path.join(args.syn_data_path, f"stop_iteration_rank{args.rank}.jsonl"),
+                                    targets, ipc_ids, iteration + 1)
+            print(f"In GPU {gpu}, {sample_convergence.frozen()} of {sub_batch_size} samples frozen, "
+                  f"the batch ran {iteration + 1} of {iterations_per_layer} iterations")
         # to reduce memory consumption by states of the optimizer we deallocate memory
         optimizer.state = collections.defaultdict(dict)
         torch.cuda.empty_cache()
@@ -274,6 +320,8 @@ def main_syn():
     parser.add_argument('--exp-name', type=str, default='test',
                         help='name of the experiment, subfolder under syn_data_path')
     parser.add_argument('--ipc-number', type=int, default=50, help='the number of each ipc')
+    parser.add_argument('--ipc-start', type=int, default=0,
+                        help='first ipc id to synthesize, -1 continues after the ids already in syn-data-path')
     parser.add_argument('--syn-data-path', type=str,
                         default='./syn_data', help='where to store synthetic data')
     parser.add_argument('--pre-train-path', type=str,
@@ -299,6 +347,15 @@ def main_syn():
                         help="$\beta_\textrm{dr}$ in our paper, controls the efficiency of GSM")
     parser.add_argument('--lr', type=float, default=0.1,
                         help='learning rate for optimization')
+    parser.add_argument('--freeze-threshold', type=float, default=0.,
+                        help='freeze an image once its CE plus feature loss improved by less than this (relative) '
+                             'over a window, 0 disables')
+    parser.add_argument('--freeze-window', type=int, default=100,
+                        help='number of iterations over which the improvement of every image is measured')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'fp16', 'bf16'],
+                        help='run the teacher forwards under autocast, the images keep an fp32 master copy')
+    parser.add_argument('--channels-last', action='store_true', default=False,
+                        help='run the teacher forwards with channels_last activations')
     parser.add_argument('--jitter', default=32, type=int, help='random shift on the synthetic data')
     parser.add_argument('--r-loss', type=float, default=0.05,
                         help='coefficient for BN and Conv feature distribution regularization')
@@ -322,6 +379,8 @@ def main_syn():
                         help="the path of the CIFAR-100's training set")
     parser.add_argument('--statistic-path', type=str, default='./statistic',
                         help="the path of the statistic file")
+    parser.add_argument('--statistic-single-pass', action='store_true', default=False,
+                        help="collect the statistics of all backbones in one pass over the training set")
     args = parser.parse_args()
 
     args.syn_data_path = os.path.join(args.syn_data_path, args.exp_name)
@@ -343,7 +402,14 @@ def main_syn():
         model_teacher[-1].load_state_dict(checkpoint)
 
     model_verifier = model_teacher[-1]
-    ipc_id_range = list(range(0, args.ipc_number))
+    if args.ipc_start < 0:
+        args.ipc_start = first_missing_ipc(args.syn_data_path, 100, args.ipc_number)
+    # only the missing ipc ids are optimized, they are written next to the existing ones
+    ipc_id_range = list(range(args.ipc_start, args.ipc_number))
+    if len(ipc_id_range) == 0:
+        print(f"ipc ids below {args.ipc_number} are all synthesized in {args.syn_data_path}")
+        return
+    print(f"synthesize ipc ids {ipc_id_range[0]} - {ipc_id_range[-1]}")
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
     port_id = 10000 + np.random.randint(0, 1000)
     args.dist_url = 'tcp://127.0.0.1:' + str(port_id)
@@ -4,8 +4,7 @@ import torch
 from torch import distributed
 import numpy as np
 import torch.nn.functional as F
-import os, sys, random
-import einops
+import os, sys, random, json
 
 
 def distributed_is_initialized():
@@ -30,6 +29,79 @@ def div_four_mul(v):
     return int(v // 4 * 4) + int(m > 0) * 4
 
 
+def conv_moments(input_0, patch_size=4):
+    '''
+    channel and 4x4 patch moments of a conv input, one var_mean reduction each over strided views,
+    equal to mean / var of "b c h w -> c (b h w)" and "b c (u h) (v w) -> (u v) (b c h w)"
+    '''
+    input_0 = input_0.float()
+    dd_var, dd_mean = torch.var_mean(input_0, dim=[0, 2, 3], unbiased=False)
+    new_h, new_w = div_four_mul(input_0.shape[2]), div_four_mul(input_0.shape[3])
+    if new_h != input_0.shape[2] or new_w != input_0.shape[3]:
+        input_0 = F.interpolate(input_0, [new_h, new_w], mode="bilinear")
+    # splitting h and w into (u h) (v w) is always a view, whatever the memory format
+    patches = input_0.reshape(input_0.shape[0], input_0.shape[1],
+                              new_h // patch_size, patch_size, new_w // patch_size, patch_size)
+    patch_var, patch_mean = torch.var_mean(patches, dim=[0, 1, 3, 5], unbiased=False)
+    return dd_mean, dd_var, patch_mean.reshape(-1), patch_var.reshape(-1)
+
+
+def class_spectrum(inputs, targets):
+    '''
+    ascending eigenvalues of every per-class Gram matrix, solved as one padded eigvalsh batch,
+    padded rows get a diagonal below any real eigenvalue, so they lead the spectrum and are flagged in the returned mask
+    '''
+    targets, order = torch.sort(targets)
+    inputs = inputs[order]
+    _, group, counts = torch.unique_consecutive(targets, return_inverse=True, return_counts=True)
+    n_max = int(counts.max())
+    rank = torch.arange(targets.shape[0], device=targets.device) - (torch.cumsum(counts, 0) - counts)[group]
+    padded = inputs.new_zeros(counts.shape[0], n_max, inputs.shape[1]).index_put((group, rank), inputs)
+    gram = padded @ padded.transpose(1, 2)
+
+    position = torch.arange(n_max, device=targets.device)[None]
+    pad_value = -(1. + gram.diagonal(dim1=1, dim2=2).sum(1).max().detach())
+    gram = gram + torch.diag_embed((position >= counts[:, None]).to(gram.dtype) * pad_value)
+    l = torch.linalg.eigvalsh(gram).float()
+
+    return l, position < (n_max - counts)[:, None]
+
+
+def nuclear_norm_loss(inputs, targets, tau=1.):
+    '''
+    per-class spectral KL of the nuclear-norm term, padded eigenvalues are masked out of both distributions
+    '''
+    l, pad = class_spectrum(inputs, targets)
+    stu = l.masked_fill(pad, float("-inf")).log_softmax(dim=-1).masked_fill(pad, 0.)
+    tea = (l / tau).masked_fill(pad, float("-inf")).softmax(dim=-1)
+    return F.kl_div(stu, tea.detach(), reduction="sum")
+
+
+def teacher_forward(model, inputs, amp_dtype=None, channels_last=False):
+    '''
+    teacher forward of the recover loop, optionally under autocast with channels_last activations;
+    the images stay the fp32 master copy, the hooks compute their moments in fp32 and the logits come back in fp32
+    '''
+    if channels_last:
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
+    if amp_dtype is None:
+        return model(inputs)
+    with torch.autocast(device_type=inputs.device.type, dtype=amp_dtype):
+        return model(inputs).float()
+
+
+def first_missing_ipc(syn_data_path, num_classes, ipc_number, suffix=".png"):
+    '''
+    smallest ipc id that is not yet written for every class, where --ipc-start -1 appends to an existing set
+    '''
+    for ipc_id in range(ipc_number):
+        for class_id in range(num_classes):
+            dir_path = '{}/new{:03d}'.format(syn_data_path, class_id)
+            if not os.path.exists(dir_path + '/class{:03d}_id{:03d}{}'.format(class_id, ipc_id, suffix)):
+                return ipc_id
+    return ipc_number
+
+
 def lr_cosine_policy(base_lr, warmup_length, epochs):
     def _lr_fn(iteration, epoch):
         if epoch < warmup_length:
@@ -99,18 +171,55 @@ def denormalize(image_tensor, use_fp16=False):
 import torch.distributed as dist
 
 
+class FeatureLossAccumulator(object):
+    '''
+    one preallocated device scalar every feature hook adds its weighted r_feature into,
+    so the per-iteration python work of the feature loss does not grow with the number of hooks / teachers
+    '''
+    def __init__(self, device):
+        self.buffer = torch.zeros((), device=device)
+        self.value = self.buffer
+        # per-sample feature terms, only kept while a SampleConvergence reads them
+        self.samples = None
+
+    def track_samples(self, number):
+        self.samples = torch.zeros(number, device=self.buffer.device) if number > 0 else None
+
+    def reset(self):
+        # a fresh graph-free alias of the same storage, the previous graph is not touched
+        self.value = self.buffer.detach().zero_()
+        if self.samples is not None:
+            self.samples.zero_()
+        return self.value
+
+    def add_(self, r_feature, weight=1.):
+        # validation / ema forwards run under no_grad and must not change the loss of the current step
+        if torch.is_grad_enabled():
+            self.value.add_(r_feature.reshape(()), alpha=weight)
+
+    def add_samples_(self, input_0, running_var, running_mean, weight=1.):
+        '''
+        the feature term of every sample on its own: its channel moments against the running statistics
+        '''
+        if self.samples is None or not torch.is_grad_enabled():
+            return
+        with torch.no_grad():
+            var, mean = torch.var_mean(input_0.float(), dim=[2, 3], unbiased=False)
+            self.samples.add_(torch.norm(running_var - var, 2, dim=1) + torch.norm(running_mean - mean, 2, dim=1),
+                              alpha=weight)
+
+
 class BNFeatureHook():
     def __init__(self, module, training_momentum=0.8):
         self.hook = module.register_forward_hook(self.hook_fn)
+        self.accumulator = None
+        self.loss_weight = 1.
         self.dd_var = 0.
         self.dd_mean = 0.
         self.momentum = training_momentum # origin = 0.2
 
     def hook_fn(self, module, input, output):
-        nch = input[0].shape[1]
-        input_0 = input[0]
-        mean = input_0.mean([0, 2, 3])
-        var = (input_0.permute(1, 0, 2, 3).contiguous().reshape([nch, -1])).var(1, unbiased=False)
+        var, mean = torch.var_mean(input[0].float(), dim=[0, 2, 3], unbiased=False)
 
         with torch.no_grad():
             if isinstance(self.dd_var, int):
@@ -122,7 +231,12 @@ class BNFeatureHook():
 
         r_feature = torch.norm(module.running_var.data - (self.dd_var + var - var.detach()), 2) + \
                     torch.norm(module.running_mean.data - (self.dd_mean + mean - mean.detach()), 2)
-        self.r_feature = r_feature
+        if self.accumulator is not None:
+            self.accumulator.add_(r_feature, self.loss_weight)
+            self.accumulator.add_samples_(input[0], module.running_var.data, module.running_mean.data,
+                                          self.loss_weight)
+        else:
+            self.r_feature = r_feature
 
     def close(self):
         self.hook.remove()
@@ -144,6 +258,8 @@ class ConvFeatureHook():
         self.patch_var = 0.
         self.patch_mean = 0.
         self.momentum = training_momentum  # origin = 0.2
+        self.accumulator = None
+        self.loss_weight = 1.
         self.drop_rate = drop_rate # 0.0 0.4 0.8
         dir = os.path.join(save_path, "ConvFeatureHook", name)
         if not os.path.exists(dir):
@@ -186,16 +302,8 @@ class ConvFeatureHook():
 
     @torch.no_grad()
     def pre_hook_fn(self, module, input, output):
-        nch = input[0].shape[1]
         bs = input[0].shape[0]
-        input_0 = input[0]
-        dd_mean = input_0.mean([0, 2, 3])
-        dd_var = (input_0.permute(1, 0, 2, 3).contiguous().reshape([nch, -1])).var(1, unbiased=False)
-        new_h, new_w = div_four_mul(input_0.shape[2]), div_four_mul(input_0.shape[3])
-        new_input_0 = F.interpolate(input_0, [new_h, new_w], mode="bilinear")
-        new_input_0 = einops.rearrange(new_input_0, "b c (u h) (v w) -> (u v) (b c h w)", h=4, w=4).contiguous()
-        patch_mean = new_input_0.mean([1])
-        patch_var = new_input_0.var([1], unbiased=False)
+        dd_mean, dd_var, patch_mean, patch_var = conv_moments(input[0])
         self.running_dd_var += (dd_var * bs / self.data_number)
         self.running_dd_mean += (dd_mean * bs / self.data_number)
         self.running_patch_var += (patch_var * bs / self.data_number)
@@ -203,17 +311,10 @@ class ConvFeatureHook():
 
     def post_hook_fn(self, module, input, output):
         if random.random() > (1. - self.drop_rate):
-            self.r_feature = torch.Tensor([0.]).to(input[0].device)
+            if self.accumulator is None:
+                self.r_feature = torch.Tensor([0.]).to(input[0].device)
             return
-        nch = input[0].shape[1]
-        input_0 = input[0]
-        dd_mean = input_0.mean([0, 2, 3])
-        dd_var = (input_0.permute(1, 0, 2, 3).contiguous().reshape([nch, -1])).var(1, unbiased=False)
-        new_h, new_w = div_four_mul(input_0.shape[2]), div_four_mul(input_0.shape[3])
-        new_input_0 = F.interpolate(input_0, [new_h, new_w], mode="bilinear")
-        new_input_0 = einops.rearrange(new_input_0, "b c (u h) (v w) -> (u v) (b c h w)", h=4, w=4).contiguous()
-        patch_mean = new_input_0.mean([1])
-        patch_var = new_input_0.var([1], unbiased=False)
+        dd_mean, dd_var, patch_mean, patch_var = conv_moments(input[0])
 
         with torch.no_grad():
             if isinstance(self.dd_var, int):
@@ -231,12 +332,78 @@ class ConvFeatureHook():
                     torch.norm(self.running_patch_mean - (self.patch_mean + patch_mean - patch_mean.detach()), 2) + \
                     torch.norm(self.running_patch_var - (self.patch_var + patch_var - patch_var.detach()), 2)
 
-        self.r_feature = r_feature
+        if self.accumulator is not None:
+            self.accumulator.add_(r_feature, self.loss_weight)
+            self.accumulator.add_samples_(input[0], self.running_dd_var, self.running_dd_mean, self.loss_weight)
+        else:
+            self.r_feature = r_feature
 
     def close(self):
         self.hook.remove()
 
 
+class SampleConvergence(object):
+    '''
+    per-sample loss tracking of a synthesis batch, the loss of a sample is its CE plus its own feature term;
+    a sample whose best loss improved by less than threshold (relative) over the last window iterations is frozen:
+    it stays in the teacher forward, so the BN / Conv moments of the batch do not change, but its gradient is
+    masked and it is kept as it is; the batch stops once every sample is frozen
+    '''
+    def __init__(self, inputs, threshold=1e-3, window=100):
+        number = inputs.shape[0]
+        self.threshold = threshold
+        self.window = window
+        self.best = torch.full((number,), float("inf"), device=inputs.device)
+        self.window_best = self.best.clone()
+        self.active = torch.ones(number, dtype=torch.bool, device=inputs.device)
+        self.stop_iteration = torch.full((number,), -1, dtype=torch.long, device=inputs.device)
+        self.frozen_inputs = inputs.detach().clone()
+        self.any_frozen = False
+        self.all_frozen = False
+
+    @torch.no_grad()
+    def update(self, losses, iteration, inputs):
+        '''
+        per-sample losses of the whole batch, returns True when a window was closed
+        '''
+        self.best = torch.minimum(self.best, losses.float())
+        if (iteration + 1) % self.window != 0:
+            return False
+        # the first window compares against inf, the nan keeps every sample active
+        improvement = (self.window_best - self.best) / self.window_best.abs().clamp_min(1e-12)
+        freeze = self.active & (improvement < self.threshold)
+        self.stop_iteration.masked_fill_(freeze, iteration + 1)
+        self.frozen_inputs = torch.where(freeze[:, None, None, None], inputs.detach(), self.frozen_inputs)
+        self.active &= ~freeze
+        self.window_best = self.best.clone()
+        # the only host sync, once per window
+        active = int(self.active.sum())
+        self.all_frozen = active == 0
+        self.any_frozen = active < self.active.numel()
+        return True
+
+    @torch.no_grad()
+    def mask_grad(self, inputs):
+        # frozen samples feed no gradient into the Adam moments
+        if self.any_frozen and inputs.grad is not None:
+            inputs.grad.masked_fill_(~self.active[:, None, None, None], 0.)
+
+    @torch.no_grad()
+    def restore(self, inputs):
+        # the Adam momentum still moves them, they are put back after the step
+        if self.any_frozen:
+            inputs.data = torch.where(self.active[:, None, None, None], inputs.data, self.frozen_inputs)
+
+    def frozen(self):
+        return int((~self.active).sum())
+
+    def save(self, path, targets, ipc_ids, iterations):
+        stop_iteration = self.stop_iteration.masked_fill(self.stop_iteration < 0, iterations)
+        with open(path, "a") as f:
+            for class_id, ipc_id, stop in zip(targets.tolist(), ipc_ids.tolist(), stop_iteration.tolist()):
+                f.write(json.dumps({"class": class_id, "ipc_id": ipc_id, "stop_iteration": stop}) + "\n")
+
+
 class GatherLayer(torch.autograd.Function):
     """Gather tensors from all process, supporting backward propagation."""
 
@@ -0,0 +1,67 @@
+'''CPU check and microbenchmark of BatchAugment against the per-iteration Compose + torch.roll of the recover loop'''
+
+import time
+import random
+import argparse
+
+import torch
+from torchvision import transforms
+
+from utils import BatchAugment
+
+"""
+python benchmark_augment.py --batch-size 32 --repeat 20
+"""
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser("Benchmark the batched augmentation")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--jitter', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    inputs = torch.randn(args.batch_size, 3, 224, 224, requires_grad=True)
+    batch_augment = BatchAugment(224, jitter=args.jitter)
+
+    # the full crop without flip is the identity, a shift is the wrapped roll
+    batch = args.batch_size
+    params = {"crop_w": torch.ones(batch), "crop_h": torch.ones(batch), "center_x": torch.zeros(batch),
+              "center_y": torch.zeros(batch), "flip": torch.ones(batch),
+              "shift_x": torch.full((batch,), 5, dtype=torch.long), "shift_y": torch.full((batch,), 7, dtype=torch.long)}
+    expected = torch.roll(inputs, shifts=(7, 5), dims=(2, 3))
+    assert torch.allclose(batch_augment(inputs, params), expected, atol=1e-5), "shifted identity mismatch"
+    params["flip"] = -torch.ones(batch)
+    params["shift_x"].zero_()
+    params["shift_y"].zero_()
+    assert torch.allclose(batch_augment(inputs, params), inputs.flip(3), atol=1e-5), "flip mismatch"
+
+    def reference():
+        aug_function = transforms.Compose([
+            transforms.RandomResizedCrop(224),
+            transforms.RandomHorizontalFlip(),
+        ])
+        inputs_jit = aug_function(inputs)
+        off1 = random.randint(0, args.jitter)
+        off2 = random.randint(0, args.jitter)
+        torch.roll(inputs_jit, shifts=(off1, off2), dims=(2, 3)).sum().backward()
+
+    def batched():
+        batch_augment(inputs).sum().backward()
+
+    ref_ms = timeit(reference, args.repeat)
+    new_ms = timeit(batched, args.repeat)
+    print(f"forward + backward  Compose + roll {ref_ms:8.2f} ms  BatchAugment {new_ms:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
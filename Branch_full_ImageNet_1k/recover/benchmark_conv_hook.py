@@ -0,0 +1,65 @@
+'''CPU microbenchmark of the ConvFeatureHook moments: the permute / rearrange reference against conv_moments'''
+
+import time
+import argparse
+
+import torch
+import einops
+import torch.nn.functional as F
+
+from utils import conv_moments, div_sixteen_mul
+
+"""
+python benchmark_conv_hook.py --batch-size 32 --repeat 10
+"""
+
+
+def reference_moments(input_0):
+    nch = input_0.shape[1]
+    dd_mean = input_0.mean([0, 2, 3])
+    dd_var = (input_0.permute(1, 0, 2, 3).contiguous().reshape([nch, -1])).var(1, unbiased=False)
+    new_h, new_w = div_sixteen_mul(input_0.shape[2]), div_sixteen_mul(input_0.shape[3])
+    new_input_0 = F.interpolate(input_0, [new_h, new_w], mode="bilinear")
+    new_input_0 = einops.rearrange(new_input_0, "b c (u h) (v w) -> (u v) (b c h w)", h=16, w=16).contiguous()
+    patch_mean = new_input_0.mean([1])
+    patch_var = new_input_0.var([1], unbiased=False)
+    return dd_mean, dd_var, patch_mean, patch_var
+
+
+def timeit(fn, input_0, repeat):
+    fn(input_0)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(input_0)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser("Benchmark the ConvFeatureHook moments")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0, help="torch cpu threads, 0 keeps the default")
+    parser.add_argument('--channels-last', action='store_true', default=False)
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    # conv inputs of a ResNet-18 at 224, the 7x7 / 14x14 stages go through the interpolation
+    shapes = [(3, 224), (64, 56), (128, 28), (256, 14), (512, 7)]
+    names = ["dd_mean", "dd_var", "patch_mean", "patch_var"]
+    torch.manual_seed(0)
+    for nch, size in shapes:
+        input_0 = torch.randn(args.batch_size, nch, size, size)
+        if args.channels_last:
+            input_0 = input_0.contiguous(memory_format=torch.channels_last)
+        for name, ref, new in zip(names, reference_moments(input_0), conv_moments(input_0)):
+            assert torch.allclose(ref, new, rtol=1e-4, atol=1e-5), \
+                f"{name} mismatch at {tuple(input_0.shape)}: {(ref - new).abs().max().item()}"
+        ref_ms = timeit(reference_moments, input_0, args.repeat)
+        new_ms = timeit(conv_moments, input_0, args.repeat)
+        print(f"{str(tuple(input_0.shape)):>22}  reference {ref_ms:8.2f} ms  fused {new_ms:8.2f} ms  "
+              f"speedup {ref_ms / new_ms:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
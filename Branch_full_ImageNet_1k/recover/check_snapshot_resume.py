@@ -0,0 +1,124 @@
+'''CPU check of the batch snapshots: a batch resumed from a snapshot takes the same next steps as an uninterrupted one'''
+
+import os
+import random
+import argparse
+import tempfile
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils import BNFeatureHook, EMABank, clip, save_synthesis_snapshot, load_synthesis_snapshot, \
+    restore_synthesis_snapshot
+
+"""
+python check_snapshot_resume.py --iterations 12 --snapshot-at 5
+"""
+
+
+def build(args):
+    # two small teachers with BN statistics, visited in turn as the aux teachers of the recover loop
+    torch.manual_seed(0)
+    teachers, hooks = [], []
+    for _ in range(2):
+        model = nn.Sequential(nn.Conv2d(3, 8, 3, padding=1), nn.BatchNorm2d(8), nn.ReLU(),
+                              nn.Conv2d(8, 16, 3, padding=1), nn.BatchNorm2d(16), nn.ReLU(),
+                              nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(16, args.classes))
+        for module in model.modules():
+            if isinstance(module, nn.BatchNorm2d):
+                module.running_mean.normal_()
+                module.running_var.uniform_(0.5, 1.5)
+        model.eval()
+        teachers.append(model)
+        hooks.append([BNFeatureHook(module) for module in model.modules() if isinstance(module, nn.BatchNorm2d)])
+    inputs = torch.randn(args.batch_size, 3, args.size, args.size, requires_grad=True)
+    targets = torch.arange(args.batch_size) % args.classes
+    optimizer = torch.optim.Adam([inputs], lr=0.1, betas=[0.5, 0.9], eps=1e-8)
+    ema_bank = EMABank(0.9, inputs, 1 + 2 * len(teachers))
+    return {"teachers": teachers, "hooks": hooks, "inputs": inputs, "targets": targets, "optimizer": optimizer,
+            "ema_bank": ema_bank, "visits": [0] * len(teachers), "outputs": [None] * len(teachers)}
+
+
+def step(run, counter, args):
+    '''one iteration of the recover loop: random flip and jitter, EMA refresh, feature and flatness terms'''
+    inputs, ema_bank = run["inputs"], run["ema_bank"]
+    flip = torch.rand(()) < 0.5
+    off1, off2 = random.randint(0, 4), random.randint(0, 4)
+    inputs_jit = torch.roll(inputs.flip(3) if flip else inputs, shifts=(off1, off2), dims=(2, 3))
+    inputs_ema_jit = torch.roll(ema_bank.value(0).flip(3) if flip else ema_bank.value(0), shifts=(off1, off2),
+                                dims=(2, 3))
+
+    run["optimizer"].zero_grad()
+    id = counter % len(run["teachers"])
+    if run["outputs"][id] is None or run["visits"][id] % args.ema_refresh_every == 0:
+        with torch.no_grad():
+            for mod in run["hooks"][id]:
+                mod.set_ema()
+            run["outputs"][id] = run["teachers"][id](inputs_ema_jit)
+    run["visits"][id] += 1
+    for mod in run["hooks"][id]:
+        mod.set_ori(flatness=True)
+    outputs = run["teachers"][id](inputs_jit)
+    loss = F.cross_entropy(outputs, run["targets"]) + 0.01 * sum(mod.r_feature for mod in run["hooks"][id]) + \
+        F.kl_div(torch.log_softmax(outputs / 4, dim=1), torch.softmax(run["outputs"][id] / 4, dim=1))
+    loss.backward()
+    run["optimizer"].step()
+    ema_bank.ema_update([0, 1 + id], inputs)
+    inputs.data = clip(inputs.data)
+    return loss.item()
+
+
+def main():
+    parser = argparse.ArgumentParser("Check that a resumed synthesis batch reproduces an uninterrupted one")
+    parser.add_argument('--iterations', type=int, default=12)
+    parser.add_argument('--snapshot-at', type=int, default=5, help="iteration after which the snapshot is taken")
+    parser.add_argument('--ema-refresh-every', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--classes', type=int, default=4)
+    parser.add_argument('--size', type=int, default=32)
+    args = parser.parse_args()
+    assert 0 < args.snapshot_at < args.iterations
+
+    path = os.path.join(tempfile.mkdtemp(), "snapshot", "rank0.pt")
+    pairs = [(int(c), 0) for c in torch.arange(args.batch_size) % args.classes]
+
+    # uninterrupted, with the snapshot written on the way
+    run = build(args)
+    torch.manual_seed(1)
+    random.seed(1)
+    hooks = [hook for hooks in run["hooks"] for hook in hooks]
+    losses = []
+    for iteration in range(args.iterations):
+        losses.append(step(run, iteration, args))
+        if iteration + 1 == args.snapshot_at:
+            save_synthesis_snapshot(path, pairs, iteration + 1, iteration + 1, run["inputs"], run["optimizer"],
+                                    run["ema_bank"], hooks, {"visits": run["visits"], "outputs": run["outputs"]})
+
+    # a fresh process: new hooks, other RNG streams, then the snapshot
+    def resume(state):
+        run = build(args)
+        torch.manual_seed(2)
+        random.seed(2)
+        hooks = [hook for hooks in run["hooks"] for hook in hooks]
+        start_iteration, counter, ema_refresh = restore_synthesis_snapshot(state, run["inputs"], run["optimizer"],
+                                                                           run["ema_bank"], hooks)
+        if ema_refresh is not None:
+            run["visits"], run["outputs"] = ema_refresh["visits"], ema_refresh["outputs"]
+        return [step(run, counter + i, args) for i in range(args.iterations - start_iteration)]
+
+    state = load_synthesis_snapshot(path, pairs)
+    resumed = resume(state)
+    expected = torch.tensor(losses[args.snapshot_at:])
+    print(f"next step loss  uninterrupted {expected[0].item():.6f}  resumed {resumed[0]:.6f}")
+    assert torch.allclose(torch.tensor(resumed), expected, rtol=1e-5, atol=1e-6), \
+        f"resumed losses {resumed} differ from {expected.tolist()}"
+
+    # the snapshot of the images, Adam and the EMA tracks alone, as written before the hook / RNG state was kept
+    partial = {key: value for key, value in state.items() if key not in ("hooks", "ema_refresh", "rng")}
+    print(f"next step loss  without hook / EMA refresh / RNG state {resume(partial)[0]:.6f}")
+    print("resume ok")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+'''Migrate the per-layer statistic/ConvFeatureHook/<Model>=<layer>/running.npz trees into one
+consolidated StatisticStore per backbone (statistic/ConvFeatureHook/<Model>.stat)'''
+
+import os
+import glob
+import shutil
+import argparse
+import collections
+
+import numpy as np
+
+from utils import StatisticStore, open_statistic_store
+
+"""
+python convert_statistic.py --statistic-path ./statistic
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser("Convert running.npz statistics into consolidated statistic stores")
+    parser.add_argument('--statistic-path', type=str, default='./statistic',
+                        help="the path of the statistic file")
+    parser.add_argument('--remove-legacy', action='store_true', default=False,
+                        help="remove the per-layer running.npz directories after the conversion")
+    args = parser.parse_args()
+
+    root = os.path.join(args.statistic_path, "ConvFeatureHook")
+    backbones = collections.defaultdict(dict)
+    for npz_path in sorted(glob.glob(os.path.join(root, "*", "running.npz"))):
+        name = os.path.basename(os.path.dirname(npz_path))
+        npz_file = np.load(npz_path)
+        backbones[name.split("=")[0]][name] = {key: npz_file[key] for key in StatisticStore.keys}
+
+    for backbone, layers in backbones.items():
+        store_path = os.path.join(root, backbone + ".stat")
+        store = open_statistic_store(store_path)
+        if store is not None:
+            # layers already in the store take precedence over the legacy files
+            for name in store.layers:
+                layers[name] = {key: value.numpy() for key, value in store.get(name).items()}
+        StatisticStore.write(store_path, layers)
+        print(f"{backbone}: {len(layers)} layers -> {store_path}")
+
+        # read back and compare before anything is removed
+        store = open_statistic_store(store_path)
+        for name, statistic in layers.items():
+            for key in StatisticStore.keys:
+                assert np.array_equal(store.get(name)[key].numpy(), np.asarray(statistic[key], dtype=np.float32)), \
+                    f"mismatch in {name}/{key}"
+        if args.remove_legacy:
+            for name in layers:
+                if os.path.isdir(os.path.join(root, name)):
+                    shutil.rmtree(os.path.join(root, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@ import os
 import random
 import argparse
 import collections
+import socket
 import time
 
 from tqdm import tqdm
@@ -31,20 +32,39 @@ def shift_list(lst, shift_count):
         new_lst.append(i)
     return new_lst
 
+def get_statistic_transform():
+    return transforms.Compose([transforms.RandomResizedCrop(224),
+                               transforms.RandomHorizontalFlip(),
+                               transforms.ToTensor(),
+                               transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                                    std=[0.229, 0.224, 0.225])])
+
+
 def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id_range):
     args.gpu = gpu
-    print("Use GPU: {} for training".format(args.gpu))
+    if args.cpu_workers > 0:
+        device = torch.device("cpu")
+        print("Use CPU worker: {} for training".format(args.gpu))
+    else:
+        device = torch.device("cuda", gpu)
+        print("Use GPU: {} for training".format(args.gpu))
+        torch.cuda.set_device(args.gpu)
     args.rank = args.rank * ngpus_per_node + gpu
-    dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
-                            world_size=args.world_size, rank=args.rank)
+    # work-queue workers are independent processes, so that workers can join late or die without a hang
+    if args.work_queue is None:
+        dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
+                                world_size=args.world_size, rank=args.rank)
 
-    torch.cuda.set_device(args.gpu)
-    model_teacher = [_model_teacher.cuda(gpu).eval() for _model_teacher in model_teacher]
+    model_teacher = [_model_teacher.to(device).eval() for _model_teacher in model_teacher]
+    if args.channels_last:
+        model_teacher = [_model_teacher.to(memory_format=torch.channels_last) for _model_teacher in model_teacher]
+    amp_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(args.amp)
+    ema_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(args.ema_dtype)
 
     for _model_teacher in model_teacher:
         for p in _model_teacher.parameters():
             p.requires_grad = False
-    model_verifier = model_verifier.cuda(gpu)
+    model_verifier = model_verifier.to(device)
     model_verifier.eval()
     for p in model_verifier.parameters():
         p.requires_grad = False
@@ -53,7 +73,7 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
     save_every = 100
     batch_size = args.batch_size
     best_cost = 1e4
-    load_tag_dict = [False for i in range(len(model_teacher))]
+    load_tag_dict = [True for i in range(len(model_teacher))]
     loss_r_feature_layers = [[] for _ in range(len(model_teacher))]
     load_tag = True
 
@@ -70,81 +90,185 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
                     full_name = str(_model_teacher.__class__.__name__) + "=" + name
                 _hook_module = ConvFeatureHook(module, save_path=args.statistic_path,
                                                name=full_name,
-                                               gpu=gpu, training_momentum=args.training_momentum,
+                                               gpu=device, training_momentum=args.training_momentum,
                                                drop_rate=args.drop_rate,
-                                               flatness_weight=args.flatness_weight)
+                                               flatness_weight=args.flatness_weight,
+                                               version=args.statistic_version[i] if args.statistic_fingerprint else None,
+                                               fingerprint=args.statistic_layer_key[i][name] if args.statistic_fingerprint else None)
                 _hook_module.set_hook(pre=True)
                 load_tag = load_tag & _hook_module.load_tag
-                load_tag_dict[i] = _hook_module.load_tag
+                load_tag_dict[i] = load_tag_dict[i] & _hook_module.load_tag
                 loss_r_feature_layers[i].append(_hook_module)
 
     sub_batch_size = int(batch_size // ngpus_per_node)
 
-    initial_img_cache = PreImgPathCache(args.initial_img_dir,transforms=transforms.Compose([
-                                                             transforms.Resize((224,224)),
-                                                             transforms.RandomHorizontalFlip(),
-                                                             transforms.ToTensor(),
-                                                             transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                                                                  std=[0.229, 0.224, 0.225])]))
+    initial_img_cache = None
+    if args.initial_img_dir is not None:
+        initial_img_cache = PreImgPathCache(args.initial_img_dir,transforms=transforms.Compose([
+                                                                 transforms.Resize((224,224)),
+                                                                 transforms.RandomHorizontalFlip(),
+                                                                 transforms.ToTensor(),
+                                                                 transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                                                                      std=[0.229, 0.224, 0.225])]))
+        if args.init_decoded:
+            initial_img_cache.decode(threads=args.init_threads)
+    if not load_tag and args.work_queue is not None:
+        raise RuntimeError("the work queue mode needs the teacher statistics, "
+                           "run the statistics pass without --work-queue first")
     if not load_tag:
         train_dataset = torchvision.datasets.ImageFolder(root=args.train_data_path,
-                                                         transform=transforms.Compose([
-                                                             transforms.RandomResizedCrop(224),
-                                                             transforms.RandomHorizontalFlip(),
-                                                             transforms.ToTensor(),
-                                                             transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                                                                  std=[0.229, 0.224, 0.225])]))
+                                                         transform=get_statistic_transform())
 
+        # every rank only visits its own shard, the partial sums are merged by ConvFeatureHook.all_reduce
+        train_sampler = ResumableDistributedSampler(train_dataset, shuffle=True)
         train_loader = torch.utils.data.DataLoader(train_dataset,
                                                    num_workers=4,
                                                    batch_size=256,
                                                    drop_last=False,
-                                                   shuffle=True)
+                                                   sampler=train_sampler)
+
+        if args.statistic_single_pass:
+            # decode every batch once and feed it to all backbones whose statistics are missing
+            statistic_passes = [[j for j in range(len(model_teacher)) if not load_tag_dict[j]]]
+        else:
+            statistic_passes = [[j] for j in range(len(model_teacher)) if not load_tag_dict[j]]
+        checkpoint_path = os.path.join(args.statistic_path, "checkpoint", f"rank{args.rank}.pt")
 
         with torch.no_grad():
-            for j, _model_teacher in enumerate(model_teacher):
-                if not load_tag_dict[j]:
-                    print(f"conduct backbone {args.aux_teacher[j]} statistics")
-                    for i, (data, _) in tqdm(enumerate(train_loader)):
-                        data = data.cuda(gpu)
-                        _ = _model_teacher(data)
-                    for _loss_t_feature_layer in loss_r_feature_layers[j]:
-                        if isinstance(_loss_t_feature_layer, ConvFeatureHook):
-                            _loss_t_feature_layer.save()
+            for teachers in statistic_passes:
+                teacher_names = [args.aux_teacher[j] for j in teachers]
+                print(f"conduct backbone {teacher_names} statistics")
+                conv_hooks = [_loss_t_feature_layer for j in teachers for _loss_t_feature_layer in loss_r_feature_layers[j]
+                              if isinstance(_loss_t_feature_layer, ConvFeatureHook)]
+                # layers whose statistics were found in the store keep them, only the others accumulate
+                collect_hooks = [_hook for _hook in conv_hooks if not _hook.load_tag]
+                start_batch = load_statistic_checkpoint(checkpoint_path, collect_hooks, teacher_names,
+                                                        args.world_size, gpu=device)
+                train_sampler.start_index = start_batch * train_loader.batch_size
+                convergence = StatisticConvergence(collect_hooks, tolerance=args.statistic_tolerance,
+                                                   patience=args.statistic_patience)
+                for i, (data, _) in tqdm(enumerate(train_loader, start_batch)):
+                    data = data.to(device)
+                    for j in teachers:
+                        _ = model_teacher[j](data)
+                    if args.statistic_checkpoint_every > 0 and (i + 1) % args.statistic_checkpoint_every == 0:
+                        save_statistic_checkpoint(checkpoint_path, collect_hooks, teacher_names, i + 1, args.world_size)
+                    if args.statistic_tolerance > 0 and convergence.update():
+                        print(f"Statistics of {teacher_names} converged after {collect_hooks[0].sample_number} samples on rank {args.rank}")
+                        break
+                    if 0 < args.statistic_sample_budget <= collect_hooks[0].sample_number * args.world_size:
+                        break
+
+                for _loss_t_feature_layer in collect_hooks:
+                    _loss_t_feature_layer.all_reduce()
+                    _loss_t_feature_layer.normalize()
+                if args.rank == 0:
+                    if args.statistic_tolerance > 0:
+                        convergence.save(os.path.join(args.statistic_path, "convergence", "+".join(teacher_names) + ".npz"))
+                    save_conv_statistics(conv_hooks)
+                # the checkpoints are only dropped once the store of this pass is on disk
+                dist.barrier()
+                if os.path.exists(checkpoint_path):
+                    os.remove(checkpoint_path)
 
         print("Training Statistic Information Is Successfully Saved")
     else:
         print("Training Statistic Information Is Successfully Load")
 
+    # every hook adds its weighted r_feature into one device scalar, first layer scaled by first_multiplier
+    loss_accumulator = FeatureLossAccumulator(device)
     for j in range(len(loss_r_feature_layers)):
-        for _loss_t_feature_layer in loss_r_feature_layers[j]:
+        for idx, _loss_t_feature_layer in enumerate(loss_r_feature_layers[j]):
             if isinstance(_loss_t_feature_layer, ConvFeatureHook):
                 _loss_t_feature_layer.set_hook(pre=False)
+            _loss_t_feature_layer.accumulator = loss_accumulator
+            _loss_t_feature_layer.loss_weight = args.first_multiplier if idx == 0 else 1.
+        if args.checkpoint_teacher:
+            # after the statistics pass, the hooks keep their layer names
+            stages = checkpoint_teacher(model_teacher[j], loss_r_feature_layers[j])
+            print(f"checkpoint {stages} stages of {args.aux_teacher[j]}")
 
     targets_all_all = torch.LongTensor(np.arange(1000))[None, ...].expand(len(ipc_id_range), 1000).contiguous().view(-1)
     ipc_id_all = torch.LongTensor(ipc_id_range)[..., None].expand(len(ipc_id_range), 1000).contiguous().view(-1)
 
-    total_number = 1000 * (ipc_id_range[-1] + 1 - ipc_id_range[0])
+    total_number = 1000 * len(ipc_id_range)
     turn_index = torch.LongTensor(np.arange(total_number)).view(len(ipc_id_range), 1000) \
         .transpose(1, 0).contiguous().view(-1)
 
-    counter = 0
-    for zz in range(0, total_number, batch_size):  # 9900 - 10000
-        sub_turn_index = turn_index[zz + gpu * sub_batch_size:min(zz + (gpu + 1) * sub_batch_size, total_number)]
-        targets = targets_all_all[sub_turn_index].cuda(gpu)
-        ipc_ids = ipc_id_all[sub_turn_index].cuda(gpu)
+    # optional sketch of the pooled 3x32x32 features, shrinks the all_gather payload and the Gram products
+    nuc_projection = None
+    if args.nuc_sketch_dim > 0:
+        nuc_projection = sketch_projection(3 * 32 * 32, args.nuc_sketch_dim, seed=args.nuc_sketch_seed).to(device)
+
+    worker_name = f"{socket.gethostname()}-{os.getpid()}" if args.work_queue is not None else f"rank{args.rank}"
+    # pairs whose images are already written by an earlier run are skipped
+    manifest = None
+    if args.store_best_images:
+        manifest = SynthesisManifest(os.path.join(args.syn_data_path, "manifest"), worker_name)
+        if dist.is_initialized():
+            # every rank has to skip the same steps, nobody may write before all have read
+            dist.barrier()
+
+    step_rank = gpu
+    if args.work_queue is not None:
+        # one task per worker batch, whole classes whenever they fit
+        queue = SynthesisQueue(args.work_queue, stale_after=args.work_queue_timeout,
+                               max_attempts=args.work_queue_max_attempts)
+        tasks = class_affine_schedule(turn_index, targets_all_all, 1, sub_batch_size)
+        queue.populate([[(int(targets_all_all[i]), int(ipc_id_all[i])) for i in task.rank_indices[0].tolist()]
+                        for task in tasks])
+        schedule = queue_schedule(queue, worker_name,
+                                  lambda class_id, ipc_id: (ipc_id - ipc_id_range[0]) * 1000 + class_id)
+        step_rank = 0
+    elif args.class_affine:
+        schedule = class_affine_schedule(turn_index, targets_all_all, ngpus_per_node, batch_size)
+    else:
+        schedule = interleaved_schedule(turn_index, ngpus_per_node, batch_size)
 
-        data_type = torch.float
-        sub_batch_size = min(zz + (gpu + 1) * sub_batch_size, total_number) - (zz + gpu * sub_batch_size)
-        if sub_batch_size < 0:
+    # built once, the transforms keep no state between calls
+    aug_function = transforms.Compose([
+        transforms.RandomResizedCrop(224),
+        transforms.RandomHorizontalFlip(),
+    ])
+    batch_augment = BatchAugment(224, jitter=args.jitter) if args.batch_augment else None
+
+    # jpeg encoding and writes overlap with the optimization of the next batch
+    image_writer = ImageWriter(threads=args.writer_threads)
+    counter = 0
+    # the initial images of the next batch of a static schedule are sampled while the current one is optimized
+    initial_img_futures = {}
+    for step_index, step in enumerate(schedule):  # 9900 - 10000
+        if initial_img_cache is not None and isinstance(schedule, list) and step_index + 1 < len(schedule):
+            next_targets = targets_all_all[schedule[step_index + 1].rank_indices[step_rank]].tolist()
+            if next_targets:
+                initial_img_futures[step_index + 1] = initial_img_cache.prefetch(next_targets,
+                                                                                 threads=args.init_threads)
+        if manifest is not None and all((int(targets_all_all[i]), int(ipc_id_all[i])) in manifest
+                                        for i in step.indices.tolist()):
+            counter += args.iteration
+            initial_img_futures.pop(step_index, None)
+            if step.task_id is not None:
+                queue.complete(step.task_id)
             continue
-        print(f"In GPU {gpu}, targets is set as: \n{targets}\n, ipc_ids is set as: \n{ipc_ids}")
+        sub_turn_index = step.rank_indices[step_rank]
+        targets = targets_all_all[sub_turn_index].to(device)
+        ipc_ids = ipc_id_all[sub_turn_index].to(device)
 
-        if args.initial_img_dir is not None:
-            inputs = torch.stack([initial_img_cache.random_img_sample(_target) for _target in targets.tolist()],0).to(f'cuda:{gpu}').to(data_type)
+        data_type = torch.float
+        # SynthesisStep gives every rank a non-empty slice, all of them run the collectives of the step
+        sub_batch_size = len(sub_turn_index)
+        saved_number = sub_batch_size - step.padding[step_rank]
+        print(f"In worker {gpu}, targets is set as: \n{targets}\n, ipc_ids is set as: \n{ipc_ids}")
+
+        if initial_img_cache is not None:
+            if step_index in initial_img_futures:
+                inputs = initial_img_futures.pop(step_index).result()
+            else:
+                inputs = initial_img_cache.sample_batch(targets.tolist())
+            inputs = inputs.to(device).to(data_type)
             inputs.requires_grad_(True)
         else:
-            inputs = torch.randn((sub_batch_size, 3, 224, 224), requires_grad=True, device=f'cuda:{gpu}',
+            inputs = torch.randn((sub_batch_size, 3, 224, 224), requires_grad=True, device=device,
                                  dtype=data_type)
 
         iterations_per_layer = args.iteration
@@ -152,92 +276,154 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
         optimizer = optim.Adam([inputs], lr=args.lr, betas=[0.5, 0.9], eps=1e-8)
         lr_scheduler = lr_cosine_policy(args.lr, 0, iterations_per_layer)  # 0 - do not use warmup
         criterion = nn.CrossEntropyLoss()
-        criterion = criterion.cuda()
-
-        inputs_ema = EMA(alpha=args.ema_alpha, initial_value=inputs)
-        backbone_ema_dict = [EMA(alpha=args.ema_alpha, initial_value=inputs) for model_name in args.aux_teacher]
-        backbone_ema_dict_tmp = [EMA(alpha=args.ema_alpha, initial_value=inputs) for model_name in args.aux_teacher]
-
-        for iteration in range(iterations_per_layer):
+        criterion = criterion.to(device)
+        # loss scaling only for fp16, disabled it passes the loss and the step through
+        scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+
+        # track 0 follows the images, 1 + j the images seen by teacher j and 1 + T + j the previous value of 1 + j
+        num_teachers = len(args.aux_teacher)
+        ema_bank = EMABank(args.ema_alpha, inputs, 1 + 2 * num_teachers, dtype=ema_dtype)
+        # only the flatness and closeness terms read the EMA tracks
+        snapshot_ema_bank = ema_bank if args.flatness or args.closeness else None
+        # the EMA-branch statistics stay in the hooks of every teacher, its logits are cached next to them
+        # staleness counts the visits of a teacher, it is only used every len(model_teacher) iterations
+        ema_visits = [0] * len(model_teacher)
+        ema_sub_outputs_cache = [None] * len(model_teacher)
+        ema_forwards = 0
+
+        # resume a batch that was interrupted mid-optimization, a reclaimed queue task continues the other worker's one
+        pairs = [(class_id, ipc_id) for class_id, ipc_id in zip(targets.tolist(), ipc_ids.tolist())]
+        # named after the batch, the removal after its images are written must not hit the next batch's snapshot
+        snapshot_path = os.path.join(args.syn_data_path, "snapshot",
+                                     f"rank{args.rank}_{pairs_digest(pairs)}.pt" if step.task_id is None
+                                     else f"task{step.task_id}.pt")
+        snapshot = load_synthesis_snapshot(snapshot_path, pairs) if args.snapshot_every > 0 else None
+        if step.gather:
+            # the ranks of a gathered step must run the same iterations, otherwise all of them start over
+            start_iteration = snapshot["iteration"] if snapshot is not None else 0
+            iteration_range = torch.tensor([start_iteration, -start_iteration], device=device)
+            dist.all_reduce(iteration_range, op=dist.ReduceOp.MAX)
+            if iteration_range[0].item() != -iteration_range[1].item():
+                snapshot = None
+        start_iteration = 0
+        # the hook targets and the RNG streams carry over between batches, the snapshot keeps them as well
+        snapshot_hooks = [hook for hooks in loss_r_feature_layers for hook in hooks]
+        if snapshot is not None:
+            start_iteration, counter, ema_refresh = restore_synthesis_snapshot(snapshot, inputs, optimizer,
+                                                                               snapshot_ema_bank, snapshot_hooks,
+                                                                               scaler)
+            if ema_refresh is not None:
+                ema_visits, ema_sub_outputs_cache = ema_refresh["visits"], ema_refresh["outputs"]
+            print(f"worker {gpu} resumes its batch at iteration {start_iteration}")
+
+        start_time = time.perf_counter()
+        for iteration in range(start_iteration, iterations_per_layer):
             # learning rate scheduling
             lr_scheduler(optimizer, iteration, iteration)
 
-            aug_function = transforms.Compose([
-                transforms.RandomResizedCrop(224),
-                transforms.RandomHorizontalFlip(),
-            ])
-            inputs_jit = aug_function(inputs)
-            inputs_ema_jit = aug_function(inputs_ema.value)
+            if batch_augment is not None:
+                # per-sample crop, flip and jitter, the EMA images share the parameters of their images
+                augment_params = batch_augment.sample(inputs)
+                inputs_jit = batch_augment(inputs, augment_params)
+                inputs_ema_jit = batch_augment(ema_bank.value(0), augment_params)
+            else:
+                inputs_jit = aug_function(inputs)
+                inputs_ema_jit = aug_function(ema_bank.value(0))
 
-            # apply random jitter offsets
-            off1 = random.randint(0, lim_0)
-            off2 = random.randint(0, lim_1)
-            inputs_jit = torch.roll(inputs_jit, shifts=(off1, off2), dims=(2, 3))
-            inputs_ema_jit = torch.roll(inputs_ema_jit, shifts=(off1, off2), dims=(2, 3))
+                # apply random jitter offsets
+                off1 = random.randint(0, lim_0)
+                off2 = random.randint(0, lim_1)
+                inputs_jit = torch.roll(inputs_jit, shifts=(off1, off2), dims=(2, 3))
+                inputs_ema_jit = torch.roll(inputs_ema_jit, shifts=(off1, off2), dims=(2, 3))
 
             # forward pass
             optimizer.zero_grad()
             id = counter % len(model_teacher)
             counter += 1
-            if args.flatness:
+            if args.flatness and (ema_sub_outputs_cache[id] is None
+                                  or ema_visits[id] % args.ema_refresh_every == 0):
                 with torch.no_grad():
                     for (idx, mod) in enumerate(loss_r_feature_layers[id]):
                         mod.set_ema()
-                    ema_sub_outputs = model_teacher[id](inputs_ema_jit)
+                    ema_sub_outputs_cache[id] = teacher_forward(model_teacher[id], inputs_ema_jit, amp_dtype,
+                                                                args.channels_last)
+                ema_forwards += 1
+            ema_visits[id] += 1
+            ema_sub_outputs = ema_sub_outputs_cache[id]
             for (idx, mod) in enumerate(loss_r_feature_layers[id]):
                 mod.set_ori(flatness=args.flatness)
-            sub_outputs = model_teacher[id](inputs_jit)
-
-            # R_cross classification loss
-            loss_ce = criterion(sub_outputs, targets)
 
-            # R_feature loss
-            rescale = [args.first_multiplier] + [1. for _ in range(len(loss_r_feature_layers[id]) - 1)]
-            loss_r_feature = sum(
-                [mod.r_feature * rescale[idx] for (idx, mod) in enumerate(loss_r_feature_layers[id])])
-
-            if args.flatness:
-                loss_ema_ce = F.kl_div(torch.log_softmax(sub_outputs / 4, dim=1),
-                                        torch.softmax(ema_sub_outputs / 4, dim=1))
-            else:
-                loss_ema_ce = torch.Tensor([0.]).to(inputs_jit.device)
+            # micro-batches run the teacher on a detached copy of the augmented images, the teacher terms are
+            # backpropagated per micro-batch into it and pushed through the augmentation together with the rest
+            micro_batch_size = args.micro_batch_size if args.micro_batch_size > 0 else inputs_jit.shape[0]
+            micro_batching = micro_batch_size < inputs_jit.shape[0]
+            teacher_inputs = inputs_jit.detach().requires_grad_(True) if micro_batching else inputs_jit
+            loss_ce = torch.zeros((), device=device)
+            loss_r_feature = torch.zeros((), device=device)
+            loss_ema_ce = torch.zeros((), device=device)
+            # the momentum update of the hook targets uses the first micro-batch only, the loss is the weighted mean
+            # of the per-micro-batch norms, not the norm of the full-batch moments
+            for begin in range(0, inputs_jit.shape[0], micro_batch_size):
+                chunk = slice(begin, begin + micro_batch_size)
+                weight = teacher_inputs[chunk].shape[0] / teacher_inputs.shape[0]
+                for mod in loss_r_feature_layers[id]:
+                    mod.update_statistics = begin == 0
+                loss_accumulator.reset()
+                sub_outputs = teacher_forward(model_teacher[id], teacher_inputs[chunk], amp_dtype, args.channels_last)
+
+                # R_cross classification loss
+                _loss_ce = criterion(sub_outputs, targets[chunk]) * weight
+
+                # R_feature loss, the BN / Conv moments are those of the micro-batch
+                _loss_r_feature = loss_accumulator.value * weight
+
+                if args.flatness:
+                    _loss_ema_ce = F.kl_div(torch.log_softmax(sub_outputs / 4, dim=1),
+                                            torch.softmax(ema_sub_outputs[chunk] / 4, dim=1)) * weight
+                else:
+                    _loss_ema_ce = torch.zeros((), device=device)
+                if micro_batching:
+                    scaler.scale(_loss_ce + args.r_loss * _loss_r_feature +
+                                 _loss_ema_ce * args.flatness_weight).backward()
+                    _loss_ce, _loss_r_feature, _loss_ema_ce = \
+                        _loss_ce.detach(), _loss_r_feature.detach(), _loss_ema_ce.detach()
+                loss_ce = loss_ce + _loss_ce
+                loss_r_feature = loss_r_feature + _loss_r_feature
+                loss_ema_ce = loss_ema_ce + _loss_ema_ce
+            for mod in loss_r_feature_layers[id]:
+                mod.update_statistics = True
             if args.closeness and (counter >= 1000): # (args.iteration // 10)
-                with torch.no_grad():
-                    idxs = shift_list(backbone_ema_dict,id)
-                    begins = range(len(backbone_ema_dict)-1,0,-1)
-                    print(idxs)
-                    differential = []
-                    for begin in begins:
-                        differential.append(backbone_ema_dict[idxs[begin-1]].value - args.ema_alpha*(backbone_ema_dict[idxs[begin]].value - backbone_ema_dict[idxs[begin-1]].value)/(1-args.ema_alpha))
-                    differential.append(backbone_ema_dict[idxs[-1]].value - args.ema_alpha*(backbone_ema_dict[idxs[0]].value-backbone_ema_dict_tmp[idxs[-1]].value)/(1-args.ema_alpha))
-                
-                loss_closeness = 0
-                for _differential in differential:
-                    loss_closeness +=  (1/len(backbone_ema_dict)) * F.mse_loss(inputs, _differential)
+                idxs = shift_list(range(num_teachers), id)
+                begins = range(num_teachers - 1, 0, -1)
+                print(idxs)
+                # d = a - alpha * (b - c) / (1 - alpha) as coefficients on the tracks, no batch-sized temporaries
+                ratio = args.ema_alpha / (1 - args.ema_alpha)
+                differential = []
+                for begin in begins:
+                    differential.append([(1 + idxs[begin - 1], 1 + ratio), (1 + idxs[begin], -ratio)])
+                differential.append([(1 + idxs[-1], 1.), (1 + idxs[0], -ratio), (1 + num_teachers + idxs[-1], ratio)])
+
+                # mean_i mse(inputs, d_i) == mse(inputs, mean_i d_i) + a constant spread
+                closeness_target, closeness_spread = ema_bank.closeness_target(differential)
+                loss_closeness = F.mse_loss(inputs, closeness_target) + closeness_spread
             else:
                 loss_closeness = torch.Tensor([0.]).to(inputs_jit.device)
 
             # Nuclear losses
             adaptivepool = nn.AdaptiveAvgPool2d((32, 32))
             re_inputs_jit = adaptivepool(inputs_jit).reshape(inputs_jit.shape[0], -1)
-            if zz + ngpus_per_node * sub_batch_size > total_number:
+            if nuc_projection is not None:
+                pooled_inputs_jit = re_inputs_jit
+                re_inputs_jit = re_inputs_jit @ nuc_projection
+            if not step.gather:
                 dist_inputs_jit = re_inputs_jit
+                _targets = targets.int()
             else:
                 dist_inputs_jit = GatherLayer.apply(re_inputs_jit)
                 dist_inputs_jit = torch.cat(dist_inputs_jit, 0)
+                _targets = targets_all_all[step.indices].to(device).int()
 
-            aux_nuc_norm_loss = 0.
-            _targets = targets_all_all[
-                turn_index[zz: min(zz + ngpus_per_node * sub_batch_size, total_number)]].cuda(gpu).int()
-            set_targets = set(_targets.tolist())
-            for i in set_targets:
-                sub_class_inputs_jit = dist_inputs_jit[_targets == i]
-                sub_class_inputs_jit = sub_class_inputs_jit @ sub_class_inputs_jit.t()
-                l = torch.linalg.eigvals(sub_class_inputs_jit).real.float()
-                stu = l.log_softmax(dim=-1)
-                tea = (l / args.tau).softmax(dim=-1)
-                aux_nuc_norm_loss += nn.KLDivLoss(reduction="sum")(stu, tea.detach())
-            nuc_norm = aux_nuc_norm_loss
+            nuc_norm = nuclear_norm_loss(dist_inputs_jit, _targets, tau=args.tau)
 
             # nuc_norm = tr(S), where U^TSV = input_jit
 
@@ -247,6 +433,11 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
 
             loss = loss_ce + loss_aux + loss_ema_ce * args.flatness_weight + loss_closeness * args.closeness_weight
 
+            if step.task_id is not None and iteration % save_every == 0:
+                queue.heartbeat(step.task_id)
+            if iteration % save_every == 0:
+                # record the batches whose images were written meanwhile
+                image_writer.poll()
             if iteration % save_every == 0 and args.gpu == 0:
                 print("------------iteration {}----------".format(iteration))
                 print("total loss", loss.item())
@@ -254,65 +445,95 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher, model_verifier, ipc_id
                 print("loss_r_feature", loss_r_feature.item())
                 print("loss_ema_ce", loss_ema_ce.item())
                 print("loss_closeness", loss_closeness.item())
-                print("main criterion",
-                      criterion(sub_outputs, targets).item())
+                if nuc_projection is not None:
+                    # exact vs sketched spectra of the local sub-batch, no extra communication
+                    print("nuc sketch report", sketch_spectrum_report(pooled_inputs_jit.detach(), nuc_projection,
+                                                                      targets, tau=args.tau))
+                print("main criterion", loss_ce.item())
                 # comment below line can speed up the training (no validation process)
                 if hook_for_display is not None:
                     hook_for_display(inputs, targets)
 
             # do image update
-            loss.backward()
-            if args.average_grad_ratio > 0:
+            if micro_batching:
+                # the teacher terms are already in teacher_inputs.grad
+                torch.autograd.backward([scaler.scale(args.nuc_norm * nuc_norm +
+                                                      loss_closeness * args.closeness_weight), inputs_jit],
+                                        [None, teacher_inputs.grad])
+            else:
+                scaler.scale(loss).backward()
+            if args.average_grad_ratio > 0 and dist.is_initialized():
                 grad = inputs_jit.grad.mean(0)
                 grad = dist.all_reduce(grad, async_op=True) / ngpus_per_node
                 inputs_jit.grad = (1 - args.average_grad_ratio) * inputs_jit.grad + (
                     args.average_grad_ratio) * grad
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
 
-            with torch.no_grad(): # 0^ 1^ 2 3 0^ 1^ 2^ 3^
-                inputs_ema.ema_update(inputs)
-                backbone_ema_dict[id].ema_update(inputs)
-                backbone_ema_dict_tmp[(id+len(args.aux_teacher)-2)%len(args.aux_teacher)].value = \
-                    backbone_ema_dict[(id+len(args.aux_teacher)-2)%len(args.aux_teacher)].value
+            # 0^ 1^ 2 3 0^ 1^ 2^ 3^
+            ema_bank.ema_update([0, 1 + id], inputs)
+            previous = (id + num_teachers - 2) % num_teachers
+            ema_bank.copy_track(1 + num_teachers + previous, 1 + previous)
             
             # clip color outlayers
             inputs.data = clip(inputs.data)
             if gpu == 0 and (best_cost > loss.item() or iteration == 1):
                 best_inputs = inputs.data.clone()
-
-        del inputs_ema
-        del backbone_ema_dict
-        del backbone_ema_dict_tmp
+            if args.snapshot_every > 0 and (iteration + 1) % args.snapshot_every == 0 \
+                    and iteration + 1 < iterations_per_layer:
+                save_synthesis_snapshot(snapshot_path, pairs, iteration + 1, counter, inputs, optimizer,
+                                        snapshot_ema_bank, snapshot_hooks,
+                                        {"visits": ema_visits, "outputs": ema_sub_outputs_cache}, scaler)
+
+        if gpu == 0 and iterations_per_layer > start_iteration:
+            elapsed = time.perf_counter() - start_time
+            print(f"batch throughput {(iterations_per_layer - start_iteration) / elapsed:.2f} it/s, "
+                  f"{ema_forwards} EMA forwards in {iterations_per_layer - start_iteration} iterations")
+            if args.report_final_accuracy and hook_for_display is not None:
+                print("final verifier accuracy", hook_for_display(inputs, targets))
+
+        del ema_bank, snapshot_ema_bank
+        del ema_sub_outputs_cache
+
+        # a batch counts as done once its images are on disk, the writer calls back on this thread
+        def on_done(pairs=pairs[:saved_number], task_id=step.task_id, snapshot_path=snapshot_path):
+            if args.store_best_images:
+                manifest.complete(pairs)
+            if task_id is not None:
+                queue.complete(task_id)
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
 
         if args.store_best_images:
             best_inputs = inputs.data.clone()  # using multicrop, save the last one
             best_inputs = denormalize(best_inputs)
-            save_images(args, best_inputs, targets, ipc_ids)
+            # the padding entries repeat images of the step, only the first saved_number are written
+            save_images(args, best_inputs[:saved_number], targets[:saved_number], ipc_ids[:saved_number],
+                        image_writer, on_done)
+        else:
+            on_done()
         # to reduce memory consumption by states of the optimizer we deallocate memory
         optimizer.state = collections.defaultdict(dict)
         torch.cuda.empty_cache()
 
+    image_writer.close()
+    if args.work_queue is not None:
+        print(f"worker {gpu} found the queue drained: {queue.progress()}")
+        queue.close()
 
-def save_images(args, images, targets, ipc_ids):
-    ipc_id_range = ipc_ids
-    for id in range(images.shape[0]):
-        if targets.ndimension() == 1:
-            class_id = targets[id].item()
-        else:
-            class_id = targets[id].argmax().item()
-
-        if not os.path.exists(args.syn_data_path):
-            os.mkdir(args.syn_data_path)
 
-        # save into separate folders
-        dir_path = '{}/new{:03d}'.format(args.syn_data_path, class_id)
-        place_to_store = dir_path + '/class{:03d}_id{:03d}.jpg'.format(class_id, ipc_id_range[id])
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path, exist_ok=True)
-
-        image_np = images[id].data.cpu().numpy().transpose((1, 2, 0))
-        pil_image = Image.fromarray((image_np * 255).astype(np.uint8))
-        pil_image.save(place_to_store)
+def save_images(args, images, targets, ipc_ids, image_writer, on_done=None):
+    class_ids = (targets if targets.ndimension() == 1 else targets.argmax(1)).tolist()
+    ipc_id_range = ipc_ids.tolist() if torch.is_tensor(ipc_ids) else list(ipc_ids)
+    if args.packed_output:
+        # lossless uint8 shards instead of jpegs, read by relabel/utils_fkd.PackedImageFolder
+        classes = ['new{:03d}'.format(i) for i in range(1000)]
+        image_writer.write_shard(images, args.syn_data_path, class_ids, ipc_id_range, classes, on_done)
+        return
+    # save into separate folders
+    paths = ['{}/new{:03d}/class{:03d}_id{:03d}.jpg'.format(args.syn_data_path, class_id, class_id, ipc_id)
+             for class_id, ipc_id in zip(class_ids, ipc_id_range)]
+    image_writer.write(images, paths, on_done)
 
 
 def validate(input, target, model):
@@ -335,6 +556,7 @@ def validate(input, target, model):
         prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
 
     print("Verifier accuracy: ", prec1.item())
+    return prec1.item()
 
 
 def main_syn():
@@ -345,20 +567,40 @@ def main_syn():
                         help='encourage the flatness or not')
     parser.add_argument('--flatness-weight', type=float, default=0.25,
                         help='the weight of flatness weight')
+    parser.add_argument('--ema-refresh-every', type=int, default=1,
+                        help='recompute the EMA-branch statistics and logits of a teacher only on every K-th '
+                             'iteration that uses this teacher, reusing them in between')
+    parser.add_argument('--report-final-accuracy', action='store_true', default=False,
+                        help='print the verifier accuracy of every batch after its last iteration, one extra '
+                             'verifier forward per batch, read by ema_refresh_sweep.sh')
     parser.add_argument('--closeness', action='store_true', default=False,
                         help='encourage the closeness or not')
     parser.add_argument('--closeness-weight', type=float, default=0.25,
                         help='the weight of closeness weight')
     parser.add_argument('--ema_alpha', type=float, default=0.9,
                         help='the weight of EMA learning rate')
+    parser.add_argument('--ema-dtype', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help='storage precision of the EMA tracks used by the flatness and closeness terms')
     parser.add_argument('--exp-name', type=str, default='test',
                         help='name of the experiment, subfolder under syn_data_path')
     parser.add_argument('--ipc-number', type=int, default=50, help='the number of each ipc')
+    parser.add_argument('--ipc-start', type=int, default=0,
+                        help='first ipc id to synthesize, -1 continues after the ids already in syn-data-path')
     parser.add_argument('--initial-img-dir', type=str, default="./syn_data/WO_OPTIM_ImageNet_1k_Recover_IPC_10", help="imgs used for initialization")
+    parser.add_argument('--init-decoded', action='store_true', default=False,
+                        help='decode the initial images once into a uint8 cache per class instead of on every sample')
+    parser.add_argument('--init-threads', type=int, default=8,
+                        help='threads decoding and prefetching the initial images')
     parser.add_argument('--syn-data-path', type=str,
                         default='./syn_data', help='where to store synthetic data')
     parser.add_argument('--store-best-images', action='store_true',
                         help='whether to store best images')
+    parser.add_argument('--packed-output', action='store_true', default=False,
+                        help='write uint8 shards with a label / ipc index instead of one jpeg per image')
+    parser.add_argument('--writer-threads', type=int, default=8,
+                        help='threads encoding and writing the synthesized images in the background')
+    parser.add_argument('--snapshot-every', type=int, default=0,
+                        help='snapshot the images and the Adam state of the current batch every N iterations, 0 disables')
     """Optimization related flags"""
     parser.add_argument('--batch-size', type=int,
                         default=100, help='number of images to optimize at the same time')
@@ -369,11 +611,35 @@ def main_syn():
                         help='node rank for distributed training')
     parser.add_argument('--dist-backend', default='nccl', type=str,
                         help='distributed backend')
+    parser.add_argument('--work-queue', type=str, default=None,
+                        help='sqlite file of a shared (class, ipc_id) work queue, workers pull batches instead of '
+                             'a static split, the same command can be started again on this node to add workers; '
+                             'the queue keeps the ipc ids it was created for, a worker started with --ipc-start -1 '
+                             'adopts them and any other mismatch is refused; '
+                             'the file has to be on a local disk, sqlite locking is not reliable on NFS')
+    parser.add_argument('--work-queue-max-attempts', type=int, default=3,
+                        help='claims of a task before it is marked failed instead of handed out again')
+    parser.add_argument('--work-queue-timeout', type=float, default=3600.,
+                        help='seconds without heartbeat after which a running task is handed to another worker')
+    parser.add_argument('--cpu-workers', type=int, default=0,
+                        help='run this many CPU workers instead of one worker per GPU, e.g. for testing')
     parser.add_argument('--iteration', type=int, default=1000,
                         help='num of iterations to optimize the synthetic data')
     parser.add_argument('--lr', type=float, default=0.1,
                         help='learning rate for optimization')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'fp16', 'bf16'],
+                        help='run the teacher forwards under autocast, the images keep an fp32 master copy')
+    parser.add_argument('--channels-last', action='store_true', default=False,
+                        help='run the teacher forwards with channels_last activations')
+    parser.add_argument('--checkpoint-teacher', action='store_true', default=False,
+                        help='recompute the activations of the teacher stages in backward instead of keeping them')
+    parser.add_argument('--micro-batch-size', type=int, default=0,
+                        help='run the teachers on sub-batches of this size and accumulate the image gradients, '
+                             'the BN / Conv statistics terms then average the norms of the sub-batch moments and '
+                             'their running targets move once per iteration with the first sub-batch, 0 disables')
     parser.add_argument('--jitter', default=32, type=int, help='random shift on the synthetic data')
+    parser.add_argument('--batch-augment', action='store_true', default=False,
+                        help='draw crop, flip and jitter per image and apply them in one grid_sample')
     parser.add_argument('--r-loss', type=float, default=0.05,
                         help='coefficient for BN and Conv feature distribution regularization')
     parser.add_argument('--first-multiplier', type=float, default=10.,
@@ -392,6 +658,12 @@ def main_syn():
     parser.add_argument('--arch-name', type=str, default='resnet18',
                         help='arch name from pretrained torchvision models')
     parser.add_argument('--tau', type=float, default=4.0, help='the temperature of nuc norm')
+    parser.add_argument('--class-affine', action='store_true', default=False,
+                        help='keep every class on one rank so the nuclear-norm term needs no all_gather')
+    parser.add_argument('--nuc-sketch-dim', type=int, default=0,
+                        help='project the pooled features to this dimension before the gather, 0 keeps the exact gram')
+    parser.add_argument('--nuc-sketch-seed', type=int, default=0,
+                        help='seed of the random projection, shared by all ranks')
     parser.add_argument('--average_grad_ratio', default=0., type=float)
     parser.add_argument('--verifier', action='store_true',
                         help='whether to evaluate synthetic data with another model')
@@ -401,6 +673,18 @@ def main_syn():
                         help="the path of the ImageNet-1k's training set")
     parser.add_argument('--statistic-path', type=str, default='./statistic',
                         help="the path of the statistic file")
+    parser.add_argument('--statistic-single-pass', action='store_true', default=False,
+                        help="collect the statistics of all backbones in one pass over the training set")
+    parser.add_argument('--statistic-checkpoint-every', type=int, default=500,
+                        help="checkpoint the statistics pass every N batches, 0 disables the checkpoints")
+    parser.add_argument('--statistic-tolerance', type=float, default=0.,
+                        help="stop the statistics pass once the relative change of every layer stays below it, 0 disables")
+    parser.add_argument('--statistic-patience', type=int, default=50,
+                        help="number of consecutive batches below --statistic-tolerance before stopping")
+    parser.add_argument('--statistic-sample-budget', type=int, default=0,
+                        help="stop the statistics pass after this many samples over all ranks, 0 uses the full set")
+    parser.add_argument('--statistic-fingerprint', action='store_true', default=False,
+                        help="key the statistics by the teacher weights, the preprocessing and the dataset manifest")
     args = parser.parse_args()
 
     args.syn_data_path = os.path.join(args.syn_data_path, args.exp_name)
@@ -413,13 +697,48 @@ def main_syn():
     for name in aux_teacher:
         model_teacher.append(models.__dict__[name](pretrained=True))
 
+    if args.statistic_fingerprint:
+        # computed once here instead of on every rank
+        data_key = dataset_fingerprint(torchvision.datasets.ImageFolder(root=args.train_data_path),
+                                       get_statistic_transform())
+        args.statistic_version, args.statistic_layer_key = [], []
+        for name, _model_teacher in zip(aux_teacher, model_teacher):
+            version, layer_key = statistic_fingerprints(_model_teacher, extra=name + data_key)
+            args.statistic_version.append(version[:16])
+            args.statistic_layer_key.append(layer_key)
+            print(f"statistics of {name} are keyed as {version[:16]}")
+
     model_verifier = models.__dict__[args.verifier_arch](pretrained=True)
-    ipc_id_range = list(range(0, args.ipc_number))
+    append = args.ipc_start < 0
+    if append:
+        args.ipc_start = first_missing_ipc(args.syn_data_path, 1000, args.ipc_number)
+    # only the missing ipc ids are optimized, they are written next to the existing ones
+    ipc_id_range = list(range(args.ipc_start, args.ipc_number))
+    if args.work_queue is not None:
+        # the task pairs are mapped back with the range the queue was created for, not the one this worker sees
+        queue = SynthesisQueue(args.work_queue)
+        queue_range = queue.bind_ipc_range(ipc_id_range)
+        queue.close()
+        if queue_range != ipc_id_range:
+            if not append or queue_range[-1] + 1 != args.ipc_number:
+                raise ValueError(f"ipc ids {args.ipc_start} - {args.ipc_number - 1} do not match the ipc ids "
+                                 f"{queue_range[0]} - {queue_range[-1]} of the queue {args.work_queue}")
+            print(f"joining the queue {args.work_queue} with its ipc ids {queue_range[0]} - {queue_range[-1]}")
+            ipc_id_range = queue_range
+            args.ipc_start = ipc_id_range[0]
+    if len(ipc_id_range) == 0:
+        print(f"ipc ids below {args.ipc_number} are all synthesized in {args.syn_data_path}")
+        return
+    print(f"synthesize ipc ids {ipc_id_range[0]} - {ipc_id_range[-1]}")
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
     port_id = 10000 + np.random.randint(0, 1000)
     args.dist_url = 'tcp://127.0.0.1:' + str(port_id)
     args.distributed = True
-    ngpus_per_node = torch.cuda.device_count()
+    if args.cpu_workers > 0:
+        ngpus_per_node = args.cpu_workers
+        args.dist_backend = 'gloo'
+    else:
+        ngpus_per_node = torch.cuda.device_count()
     args.world_size = ngpus_per_node * args.world_size
     torch.multiprocessing.set_start_method('spawn')
     mp.spawn(main_worker, nprocs=ngpus_per_node,
@@ -13,10 +13,13 @@ import torch
 import einops
 import torch.utils
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision import transforms
 import torchvision.models as models
 import torch.utils.data.distributed
 import torch.distributed as dist
+
+from utils import ImageWriter
 mp.set_sharing_strategy('file_system')
 
 """
@@ -45,6 +48,49 @@ def denormalize(image_tensor, use_fp16=False):
     return image_tensor
 
 
+def select_top_k(loader, model_teacher, loss_function, k, gpu, resolution=0, indices=None):
+    '''
+    running per-class top-k of the lowest ensemble losses over the loader, kept on the device and merged batch by batch;
+    indices maps the positions of the loader (e.g. of a Subset) to dataset indices, -1 pads short classes
+    '''
+    best_loss = torch.full((1000, k), float("inf"), device=gpu)
+    best_index = torch.full((1000, k), -1, dtype=torch.long, device=gpu)
+    if indices is not None:
+        indices = torch.as_tensor(indices, dtype=torch.long, device=gpu)
+    offset = 0
+    with torch.no_grad():
+        for i, (data, label) in enumerate(loader):
+            print(f"Pass {i * 100 / len(loader)}%", end="\r")
+            data = data.cuda(gpu, non_blocking=True)
+            label = label.cuda(gpu, non_blocking=True)
+            if 0 < resolution != data.shape[-1]:
+                data = F.interpolate(data, size=(resolution, resolution), mode="bilinear", align_corners=False)
+            total_output = []
+            for j, _model_teacher in enumerate(model_teacher):
+                output = _model_teacher(data)
+                total_output.append(output)
+            total_output = torch.stack(total_output, 0).mean(0)
+            loss = loss_function(total_output, label)
+            index = offset + torch.arange(data.shape[0], device=loss.device)
+            offset += data.shape[0]
+            if indices is not None:
+                index = indices[index]
+
+            # one row per class of the batch, every sample in its own column, the rest +inf
+            classes, rows = torch.unique(label, return_inverse=True)
+            columns = torch.arange(data.shape[0], device=loss.device)
+            batch_loss = torch.full((classes.shape[0], data.shape[0]), float("inf"), device=loss.device)
+            batch_index = torch.full((classes.shape[0], data.shape[0]), -1, dtype=torch.long, device=loss.device)
+            batch_loss[rows, columns] = loss.float()
+            batch_index[rows, columns] = index
+            merged_loss = torch.cat([best_loss[classes], batch_loss], 1)
+            merged_index = torch.cat([best_index[classes], batch_index], 1)
+            top_loss, top_position = merged_loss.topk(k, dim=1, largest=False, sorted=True)
+            best_loss[classes] = top_loss
+            best_index[classes] = merged_index.gather(1, top_position)
+    return best_loss, best_index
+
+
 def main_worker(gpu, ngpus_per_node, args, model_teacher):
     args.gpu = gpu
     print("Use GPU: {} for training".format(args.gpu))
@@ -72,47 +118,55 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher):
     patch_operator = transforms.Compose([transforms.RandomResizedCrop(224),
                                          transforms.RandomHorizontalFlip()])
     loss_function = nn.CrossEntropyLoss(reduction="none")
-    pre_patch_memory = [[] for _ in range(1000)]
+    pre_select_number = 300
 
-    iter_number = 1281167 / 256
     print("Begin Pre-Selecting Images in the training dataset")
     if os.path.exists("./pre_patch_memory.npz"):
         pre_patch_memory = np.load("./pre_patch_memory.npz")["pre_patch_memory"]
 
     else:
-        with torch.no_grad():
-            for i, (data, label) in enumerate(train_loader):
-                print(f"Pass {i * 100 / iter_number}%", end="\r")
-                data = data.cuda(gpu)
-                label = label.cuda(gpu)
-                total_output = []
-                for j, _model_teacher in enumerate(model_teacher):
-                    output = _model_teacher(data)
-                    total_output.append(output)
-                total_output = torch.stack(total_output, 0).mean(0)
-                loss = loss_function(total_output, label)
-                for j in range(data.shape[0]):
-                    _loss = loss[j].item()
-                    _label = label[j].item()
-                    pre_patch_memory[_label].append([i * 256 + j, _loss])
-
-        for i in range(len(pre_patch_memory)):
-            if len(pre_patch_memory[i]) != 0:
-                pre_patch_memory[i] = [kk[0] for kk in sorted(pre_patch_memory[i], key=lambda x: x[1])[:300]]
-
-        pre_patch_memory = np.array(pre_patch_memory)
+        if args.cascade_teacher is None:
+            _, best_index = select_top_k(train_loader, model_teacher, loss_function, pre_select_number, gpu)
+        else:
+            # the cheap teacher scores everything, only its top-M of every class is rescored by the ensemble
+            cheap_teacher = model_teacher[args.aux_teacher.index(args.cascade_teacher)]
+            _, cascade_index = select_top_k(train_loader, [cheap_teacher], loss_function, args.cascade_top, gpu,
+                                            resolution=args.cascade_resolution)
+            candidates = cascade_index[cascade_index >= 0].sort()[0].cpu()
+            candidate_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(train_dataset, candidates.tolist()),
+                                                           num_workers=4,
+                                                           batch_size=256,
+                                                           drop_last=False,
+                                                           shuffle=False)
+            _, best_index = select_top_k(candidate_loader, model_teacher, loss_function, pre_select_number, gpu,
+                                         indices=candidates)
+            print(f"cascade rescored {candidates.shape[0]} of {len(train_dataset)} images with the full ensemble")
+            if args.cascade_report:
+                # the exhaustive selection, only to measure what the cascade changes
+                _, exhaustive_index = select_top_k(train_loader, model_teacher, loss_function, pre_select_number, gpu)
+                overlap = []
+                for cascade_row, exhaustive_row in zip(best_index.tolist(), exhaustive_index.tolist()):
+                    exhaustive_row = set(j for j in exhaustive_row if j >= 0)
+                    overlap.append(len(exhaustive_row & set(cascade_row)) / max(len(exhaustive_row), 1))
+                overlap = np.array(overlap)
+                print(f"cascade vs. exhaustive top-{pre_select_number}: {(overlap < 1).sum()} of {len(overlap)} classes "
+                      f"differ, overlap mean {overlap.mean():.4f} min {overlap.min():.4f}")
+
+        # dense (1000, pre_select_number) candidate index sorted by loss
+        pre_patch_memory = best_index.cpu().numpy()
         np.savez("./pre_patch_memory.npz", pre_patch_memory=pre_patch_memory)
 
     print("Begin Post-Selecting Images in the training dataset")
 
     intermediate_path = "./intermediate_path/"
+    image_writer = ImageWriter(threads=args.writer_threads)
 
     if not os.path.exists(intermediate_path):
         new_patch_memory = [[] for _ in range(1000)]
         with torch.no_grad():
             for i in tqdm(range(pre_patch_memory.shape[0])):
                 counter = 0
-                index_list = pre_patch_memory[i].tolist()
+                index_list = [j for j in pre_patch_memory[i].tolist() if j >= 0]
                 total_data, total_label = [], []
                 for j in index_list:
                     data, label = train_dataset[j]
@@ -138,17 +192,12 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher):
                     total_output = torch.stack(total_output, 0).mean(0)
                     local_patch_loss = loss_function(total_output, local_patch_label[..., 0])
                     local_patch_data = denormalize(local_patch_data)
-                    for j in range(local_patch_data.shape[0]):
-                        _loss = local_patch_loss[j].item()
-                        _label = local_patch_label[j].item()
-                        # save into separate folders
-                        dir_path = '{}/new{:03d}'.format(intermediate_path, _label)
-                        place_to_store = dir_path + '/loss{}_id{:03d}.jpg'.format(round(_loss, 12), counter)
-                        if not os.path.exists(dir_path):
-                            os.makedirs(dir_path, exist_ok=True)
-                        image_np = local_patch_data[j].data.cpu().numpy().transpose((1, 2, 0))
-                        pil_image = Image.fromarray((image_np * 255).astype(np.uint8))
-                        pil_image.save(place_to_store)
+                    # save into separate folders
+                    paths = ['{}/new{:03d}/loss{}_id{:03d}.jpg'.format(intermediate_path, _label, round(_loss, 12), counter)
+                             for _loss, _label in zip(local_patch_loss.tolist(), local_patch_label[:, 0].tolist())]
+                    image_writer.write(local_patch_data, paths)
+        # the candidates are read back below
+        image_writer.flush()
 
     print("Begin Image Synthetic from the candidate list")
 
@@ -172,31 +221,24 @@ def main_worker(gpu, ngpus_per_node, args, model_teacher):
         labels = labels.int()
         images = total_image  # (IPC,C,H,W)
         ipc_ids = [j for j in range(total_image.shape[0])]
-        save_images(args, images, labels, ipc_ids)
+        save_images(args, images, labels, ipc_ids, image_writer)
 
+    image_writer.close()
     torch.cuda.empty_cache()
 
 
-def save_images(args, images, targets, ipc_ids):
-    ipc_id_range = ipc_ids
-    for id in range(images.shape[0]):
-        if targets.ndimension() == 1:
-            class_id = targets[id].item()
-        else:
-            class_id = targets[id].argmax().item()
-
-        if not os.path.exists(args.syn_data_path):
-            os.mkdir(args.syn_data_path)
-
-        # save into separate folders
-        dir_path = '{}/new{:03d}'.format(args.syn_data_path, class_id)
-        place_to_store = dir_path + '/class{:03d}_id{:03d}.jpg'.format(class_id, ipc_id_range[id])
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path, exist_ok=True)
-
-        image_np = images[id].data.cpu().numpy().transpose((1, 2, 0))
-        pil_image = Image.fromarray((image_np * 255).astype(np.uint8))
-        pil_image.save(place_to_store)
+def save_images(args, images, targets, ipc_ids, image_writer, on_done=None):
+    class_ids = (targets if targets.ndimension() == 1 else targets.argmax(1)).tolist()
+    ipc_id_range = ipc_ids.tolist() if torch.is_tensor(ipc_ids) else list(ipc_ids)
+    if args.packed_output:
+        # lossless uint8 shards instead of jpegs, read by relabel/utils_fkd.PackedImageFolder
+        classes = ['new{:03d}'.format(i) for i in range(1000)]
+        image_writer.write_shard(images, args.syn_data_path, class_ids, ipc_id_range, classes, on_done)
+        return
+    # save into separate folders
+    paths = ['{}/new{:03d}/class{:03d}_id{:03d}.jpg'.format(args.syn_data_path, class_id, class_id, ipc_id)
+             for class_id, ipc_id in zip(class_ids, ipc_id_range)]
+    image_writer.write(images, paths, on_done)
 
 
 def main_syn():
@@ -208,6 +250,10 @@ def main_syn():
     parser.add_argument('--ipc-number', type=int, default=50, help='the number of each ipc')
     parser.add_argument('--syn-data-path', type=str,
                         default='./syn_data', help='where to store synthetic data')
+    parser.add_argument('--packed-output', action='store_true', default=False,
+                        help='write uint8 shards with a label / ipc index instead of one jpeg per image')
+    parser.add_argument('--writer-threads', type=int, default=8,
+                        help='threads encoding and writing the images in the background')
     """Optimization related flags"""
     parser.add_argument('--gpu-id', type=str, default='0,1')
     parser.add_argument('--world-size', default=1, type=int,
@@ -219,6 +265,15 @@ def main_syn():
     """Model related flags"""
     parser.add_argument('--train-data-path', type=str, default='./imagenet/train',
                         help="the path of the ImageNet-1k's training set")
+    parser.add_argument('--cascade-teacher', type=str, default=None,
+                        help='pre-select with this teacher alone first and rescore only its top candidates '
+                             'with the full ensemble, e.g. shufflenet_v2_x0_5')
+    parser.add_argument('--cascade-resolution', type=int, default=0,
+                        help='input resolution of the cascade teacher, 0 keeps 224')
+    parser.add_argument('--cascade-top', type=int, default=600,
+                        help='candidates per class rescored by the full ensemble')
+    parser.add_argument('--cascade-report', action='store_true', default=False,
+                        help='also run the exhaustive pre-selection and report how often the cascade differs from it')
     args = parser.parse_args()
 
     args.syn_data_path = os.path.join(args.syn_data_path, args.exp_name)
@@ -226,6 +281,11 @@ def main_syn():
         os.makedirs(args.syn_data_path)
 
     aux_teacher = ["resnet18", "mobilenet_v2", "efficientnet_b0", "shufflenet_v2_x0_5"]  # "densenet121
+    if args.cascade_teacher is not None and args.cascade_teacher not in aux_teacher:
+        raise ValueError(f"--cascade-teacher should be one of {aux_teacher}")
+    if args.cascade_teacher is not None and args.cascade_top < 300:
+        raise ValueError("--cascade-top should keep at least the 300 pre-selected images of a class")
+    args.aux_teacher = aux_teacher
     model_teacher = []
     for name in aux_teacher:
         model_teacher.append(models.__dict__[name](pretrained=True))
@@ -0,0 +1,27 @@
+# throughput vs. final verifier accuracy of --flatness for several EMA refresh intervals, K counts the
+# iterations that use a teacher (every len(aux_teacher)-th iteration), so K=1 is the exact EMA forward,
+# every run synthesizes the same small subset (ipc 0 of every class) from the same initialization
+INITIAL_IMG_DIR=/path/to/syn_data/WO_OPTIM_ImageNet_1k_Recover_IPC_10
+TRAIN_DATA_PATH=/path/to/imagenet-1k/train
+
+for K in 1 2 4 8 16; do
+    CUDA_VISIBLE_DEVICES=0 python data_synthesis_with_svd_with_db_with_all_statistic.py \
+        --arch-name "resnet18" \
+        --exp-name "EMA_REFRESH_${K}" \
+        --syn-data-path ./syn_data_ema_refresh \
+        --batch-size 100 \
+        --lr 0.05 \
+        --ipc-number 1 --training-momentum 0.8 --flatness --ema-refresh-every ${K} \
+        --iteration 1000 \
+        --train-data-path ${TRAIN_DATA_PATH} \
+        --l2-scale 0 --tv-l2 0 --r-loss 0.01 --nuc-norm 1. \
+        --verifier --report-final-accuracy --store-best-images --gpu-id 0 --initial-img-dir ${INITIAL_IMG_DIR} \
+        2>&1 | tee ema_refresh_${K}.log
+done
+
+# mean over the batches of every run
+for K in 1 2 4 8 16; do
+    awk -v k=${K} '/^batch throughput/ {speed += $3; n += 1} /^final verifier accuracy/ {acc += $4; m += 1}
+        END {printf "refresh every %3d: %8.2f it/s  final verifier accuracy %6.2f\n", k, speed / n, acc / m}' \
+        ema_refresh_${K}.log
+done
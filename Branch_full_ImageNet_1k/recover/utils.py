@@ -4,9 +4,12 @@ import torch
 from torch import distributed
 import numpy as np
 import torch.nn.functional as F
-import os, sys, random
-import einops
+import os, sys, math, random, json, glob, hashlib, collections, sqlite3, time
+import concurrent.futures
+from PIL import Image
 import torch.distributed as dist
+import torch.utils.data.distributed
+import torch.utils.checkpoint
 
 
 def distributed_is_initialized():
@@ -31,6 +34,136 @@ def div_sixteen_mul(v):
     return int(v // 16 * 16) + int(m > 0) * 16
 
 
+def conv_moments(input_0, patch_size=16):
+    '''
+    channel and 16x16 patch moments of a conv input, one var_mean reduction each over strided views,
+    equal to mean / var of "b c h w -> c (b h w)" and "b c (u h) (v w) -> (u v) (b c h w)"
+    '''
+    input_0 = input_0.float()
+    dd_var, dd_mean = torch.var_mean(input_0, dim=[0, 2, 3], unbiased=False)
+    new_h, new_w = div_sixteen_mul(input_0.shape[2]), div_sixteen_mul(input_0.shape[3])
+    if new_h != input_0.shape[2] or new_w != input_0.shape[3]:
+        input_0 = F.interpolate(input_0, [new_h, new_w], mode="bilinear")
+    # splitting h and w into (u h) (v w) is always a view, whatever the memory format
+    patches = input_0.reshape(input_0.shape[0], input_0.shape[1],
+                              new_h // patch_size, patch_size, new_w // patch_size, patch_size)
+    patch_var, patch_mean = torch.var_mean(patches, dim=[0, 1, 3, 5], unbiased=False)
+    return dd_mean, dd_var, patch_mean.reshape(-1), patch_var.reshape(-1)
+
+
+def class_spectrum(inputs, targets):
+    '''
+    ascending eigenvalues of every per-class Gram matrix, solved as one padded eigvalsh batch,
+    padded rows get a diagonal below any real eigenvalue, so they lead the spectrum and are flagged in the returned mask
+    '''
+    targets, order = torch.sort(targets)
+    inputs = inputs[order]
+    _, group, counts = torch.unique_consecutive(targets, return_inverse=True, return_counts=True)
+    n_max = int(counts.max())
+    rank = torch.arange(targets.shape[0], device=targets.device) - (torch.cumsum(counts, 0) - counts)[group]
+    padded = inputs.new_zeros(counts.shape[0], n_max, inputs.shape[1]).index_put((group, rank), inputs)
+    gram = padded @ padded.transpose(1, 2)
+
+    position = torch.arange(n_max, device=targets.device)[None]
+    pad_value = -(1. + gram.diagonal(dim1=1, dim2=2).sum(1).max().detach())
+    gram = gram + torch.diag_embed((position >= counts[:, None]).to(gram.dtype) * pad_value)
+    l = torch.linalg.eigvalsh(gram).float()
+
+    return l, position < (n_max - counts)[:, None]
+
+
+def nuclear_norm_loss(inputs, targets, tau=1.):
+    '''
+    per-class spectral KL of the nuclear-norm term, padded eigenvalues are masked out of both distributions
+    '''
+    l, pad = class_spectrum(inputs, targets)
+    stu = l.masked_fill(pad, float("-inf")).log_softmax(dim=-1).masked_fill(pad, 0.)
+    tea = (l / tau).masked_fill(pad, float("-inf")).softmax(dim=-1)
+    return F.kl_div(stu, tea.detach(), reduction="sum")
+
+
+def teacher_forward(model, inputs, amp_dtype=None, channels_last=False):
+    '''
+    teacher forward of the recover loop, optionally under autocast with channels_last activations;
+    the images stay the fp32 master copy, the hooks compute their moments in fp32 and the logits come back in fp32
+    '''
+    if channels_last:
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
+    if amp_dtype is None:
+        return model(inputs)
+    with torch.autocast(device_type=inputs.device.type, dtype=amp_dtype):
+        return model(inputs).float()
+
+
+def sketch_projection(in_dim, out_dim, seed=0):
+    '''
+    fixed gaussian projection with E[S S^T] = I, so (x S)(x S)^T is an unbiased sketch of the Gram matrix,
+    drawn from its own generator so that every rank builds the same matrix
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(in_dim, out_dim, generator=generator) / (out_dim ** 0.5)
+
+
+@torch.no_grad()
+def sketch_spectrum_report(inputs, projection, targets, tau=1.):
+    '''
+    how closely the sketched class spectra track the exact ones on one batch
+    '''
+    exact, pad = class_spectrum(inputs, targets)
+    sketch, _ = class_spectrum(inputs @ projection, targets)
+    exact, sketch = exact.masked_fill(pad, 0.), sketch.masked_fill(pad, 0.)
+    relative = (sketch - exact).norm(dim=1) / exact.norm(dim=1).clamp_min(1e-12)
+    # the largest eigenvalue carries most of the softmax mass of the loss
+    top = (sketch[:, -1] - exact[:, -1]).abs() / exact[:, -1].abs().clamp_min(1e-12)
+    return {"spectrum_error_mean": relative.mean().item(), "spectrum_error_max": relative.max().item(),
+            "top_eigenvalue_error": top.mean().item(),
+            "loss_exact": nuclear_norm_loss(inputs, targets, tau).item(),
+            "loss_sketch": nuclear_norm_loss(inputs @ projection, targets, tau).item()}
+
+
+# the packed shard format, read by relabel/utils_fkd.py (PackedImageFolder); keep both sides in sync
+def write_packed_shard(root, name, images, labels, ipc_ids, classes):
+    '''
+    one shard of a packed distilled dataset: shard_<name>.npy holds the (N, H, W, 3) uint8 images and
+    shard_<name>.npz their labels, ipc ids and the class names; both are renamed into place, the index last
+    '''
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, "shard_" + name)
+    with open(path + ".npy.tmp", "wb") as f:
+        np.save(f, np.ascontiguousarray(images, dtype=np.uint8))
+    with open(path + ".npz.tmp", "wb") as f:
+        np.savez(f, label=np.asarray(labels, dtype=np.int64), ipc_id=np.asarray(ipc_ids, dtype=np.int64),
+                 classes=np.array(classes))
+    os.replace(path + ".npy.tmp", path + ".npy")
+    os.replace(path + ".npz.tmp", path + ".npz")
+
+
+def packed_pairs(root):
+    '''
+    the (label, ipc_id) pairs stored in the shards of a packed folder
+    '''
+    pairs = set()
+    for index_path in glob.glob(os.path.join(root, "shard_*.npz")):
+        index = np.load(index_path)
+        pairs.update(zip(index["label"].tolist(), index["ipc_id"].tolist()))
+    return pairs
+
+
+def first_missing_ipc(syn_data_path, num_classes, ipc_number, suffix=".jpg"):
+    '''
+    smallest ipc id that is not yet written for every class, where --ipc-start -1 appends to an existing set;
+    images of packed shards count as written
+    '''
+    packed = packed_pairs(syn_data_path)
+    for ipc_id in range(ipc_number):
+        for class_id in range(num_classes):
+            dir_path = '{}/new{:03d}'.format(syn_data_path, class_id)
+            if (class_id, ipc_id) not in packed and \
+                    not os.path.exists(dir_path + '/class{:03d}_id{:03d}{}'.format(class_id, ipc_id, suffix)):
+                return ipc_id
+    return ipc_number
+
+
 def lr_cosine_policy(base_lr, warmup_length, epochs):
     def _lr_fn(iteration, epoch):
         if epoch < warmup_length:
@@ -111,9 +244,227 @@ class EMA(object):
             self.value = self.alpha * self.value + (1 - self.alpha) * x
 
 
+class EMABank(object):
+    '''
+    all EMA tracks of a synthesis batch in one preallocated (tracks, *images) buffer, updated in place and
+    optionally stored in reduced precision; a track that was never updated mirrors the live images,
+    as an EMA initialized with the images tensor itself does
+    '''
+    def __init__(self, alpha, inputs, tracks, dtype=None):
+        self.alpha = alpha
+        self.inputs = inputs
+        self.buffer = torch.zeros((tracks,) + tuple(inputs.shape), dtype=dtype or inputs.dtype, device=inputs.device)
+        self.initialized = [False] * tracks
+
+    def value(self, track):
+        if not self.initialized[track]:
+            return self.inputs
+        return self.buffer[track].to(self.inputs.dtype)
+
+    @torch.no_grad()
+    def ema_update(self, tracks, x):
+        x = x.detach()
+        running = [self.buffer[track] for track in tracks if self.initialized[track]]
+        for track in tracks:
+            if not self.initialized[track]:
+                # alpha * x + (1 - alpha) * x of a mirroring track
+                self.buffer[track].copy_(x)
+                self.initialized[track] = True
+        if running:
+            torch._foreach_mul_(running, self.alpha)
+            torch._foreach_add_(running, [x] * len(running), alpha=1 - self.alpha)
+
+    @torch.no_grad()
+    def copy_track(self, target, source):
+        if self.initialized[source]:
+            self.buffer[target].copy_(self.buffer[source])
+        self.initialized[target] = self.initialized[source]
+
+    @torch.no_grad()
+    def closeness_target(self, differentials, chunk_size=1 << 20):
+        '''
+        every differential is a list of (track, coefficient); returns the mean differential and the spread term with
+        mean_i mse(x, d_i) = mse(x, mean) + spread, built with one batch-sized temporary and a Gram matrix of the tracks
+        '''
+        tracks = len(self.initialized)
+        # mirroring tracks are folded onto the live images, the last source
+        coefficients = torch.zeros(len(differentials), tracks + 1, dtype=torch.float64)
+        for i, differential in enumerate(differentials):
+            for track, coefficient in differential:
+                coefficients[i, track if self.initialized[track] else tracks] += coefficient
+        weights = coefficients.mean(0)
+
+        x = self.inputs.detach()
+        mean = x * float(weights[tracks])
+        for track in range(tracks):
+            if weights[track] != 0:
+                mean.add_(self.buffer[track], alpha=float(weights[track]))
+
+        # Gram of the tracks and the images accumulated in fp64 over column chunks, a reduced-precision bank
+        # would overflow (fp16) or lose the spread in rounding (bf16), and no full-size fp64 copy is made
+        flat = self.buffer.view(tracks, -1)
+        x_flat = x.reshape(1, -1)
+        gram = torch.zeros(tracks + 1, tracks + 1, dtype=torch.float64, device=x.device)
+        for begin in range(0, x_flat.shape[1], chunk_size):
+            block = torch.cat([flat[:, begin:begin + chunk_size].double(),
+                               x_flat[:, begin:begin + chunk_size].double()], 0)
+            gram += block @ block.t()
+        gram = gram.cpu()
+        spread = (torch.trace(coefficients @ gram @ coefficients.t()) / len(differentials)
+                  - weights @ gram @ weights) / x.numel()
+        return mean, float(spread)
+
+    def state_dict(self):
+        # the tracks still mirroring the images carry no state
+        return {"tracks": {track: self.buffer[track].cpu() for track, initialized in enumerate(self.initialized)
+                           if initialized}}
+
+    def load_state_dict(self, state):
+        self.initialized = [False] * len(self.initialized)
+        for track, value in state["tracks"].items():
+            self.buffer[track].copy_(value)
+            self.initialized[track] = True
+
+
+class BatchAugment(object):
+    '''
+    RandomResizedCrop + RandomHorizontalFlip + the wrapped jitter roll with independent parameters per sample,
+    applied as one differentiable grid_sample; built once, works on any device
+    '''
+    def __init__(self, size=224, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), jitter=32):
+        self.size = size
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.jitter = jitter
+
+    def sample(self, inputs):
+        batch, _, height, width = inputs.shape
+        device = inputs.device
+        area = torch.empty(batch, device=device).uniform_(*self.scale)
+        ratio = torch.empty(batch, device=device).uniform_(*self.log_ratio).exp()
+        # crop sides relative to the image, clamped where torchvision would draw again
+        crop_w = (area * ratio * height / width).sqrt().clamp(max=1.)
+        crop_h = (area / ratio * width / height).sqrt().clamp(max=1.)
+        return {"crop_w": crop_w, "crop_h": crop_h,
+                "center_x": (2 * torch.rand(batch, device=device) - 1) * (1 - crop_w),
+                "center_y": (2 * torch.rand(batch, device=device) - 1) * (1 - crop_h),
+                "flip": 1. - 2. * (torch.rand(batch, device=device) < 0.5).float(),
+                "shift_x": torch.randint(0, self.jitter + 1, (batch,), device=device),
+                "shift_y": torch.randint(0, self.jitter + 1, (batch,), device=device)}
+
+    def __call__(self, inputs, params=None):
+        if params is None:
+            params = self.sample(inputs)
+        position = torch.arange(self.size, device=inputs.device)
+        # the roll is a permutation of the output pixels, so it is folded into the sampling grid
+        cols = ((position[None] - params["shift_x"][:, None]) % self.size + 0.5) / self.size * 2 - 1
+        rows = ((position[None] - params["shift_y"][:, None]) % self.size + 0.5) / self.size * 2 - 1
+        x = params["center_x"][:, None] + params["crop_w"][:, None] * params["flip"][:, None] * cols
+        y = params["center_y"][:, None] + params["crop_h"][:, None] * rows
+        grid = torch.stack([x[:, None, :].expand(-1, self.size, -1), y[:, :, None].expand(-1, -1, self.size)], -1)
+        return F.grid_sample(inputs, grid.to(inputs.dtype), mode="bilinear", padding_mode="border",
+                             align_corners=False)
+
+
+class FeatureLossAccumulator(object):
+    '''
+    one preallocated device scalar every feature hook adds its weighted r_feature into,
+    so the per-iteration python work of the feature loss does not grow with the number of hooks / teachers
+    '''
+    def __init__(self, device):
+        self.buffer = torch.zeros((), device=device)
+        self.value = self.buffer
+
+    def reset(self):
+        # a fresh graph-free alias of the same storage, the previous graph is not touched
+        self.value = self.buffer.detach().zero_()
+        return self.value
+
+    def add_(self, r_feature, weight=1.):
+        # validation / ema forwards run under no_grad and must not change the loss of the current step
+        if torch.is_grad_enabled():
+            self.value.add_(r_feature.reshape(()), alpha=weight)
+
+
+class StageLossAccumulator(object):
+    '''
+    out-of-place sum of the weighted r_feature of the hooks inside a checkpointed stage, also under no_grad,
+    so that it can be returned as an output of the checkpointed function
+    '''
+    def __init__(self, device):
+        self.value = torch.zeros((), device=device)
+
+    def add_(self, r_feature, weight=1.):
+        self.value = self.value + weight * r_feature.reshape(())
+
+
+class CheckpointedStage(torch.nn.Module):
+    '''
+    teacher stage under activation checkpointing: its hooks add into a stage-local accumulator that is returned
+    next to the stage output and passed on to their own accumulator, so r_feature keeps its gradient; during the
+    recompute in backward the hooks replay their drop decisions and skip their momentum updates
+    '''
+    def __init__(self, stage, hooks):
+        super().__init__()
+        self.stage = stage
+        self.hooks = hooks
+
+    def run(self, x):
+        # the reentrant checkpoint runs the first pass under no_grad and the recompute with grad enabled
+        recompute = torch.is_grad_enabled()
+        accumulator = StageLossAccumulator(x.device)
+        accumulators = [hook.accumulator for hook in self.hooks]
+        for hook in self.hooks:
+            hook.accumulator = accumulator
+            hook.recompute = recompute
+        try:
+            output = self.stage(x)
+        finally:
+            for hook, _accumulator in zip(self.hooks, accumulators):
+                hook.accumulator = _accumulator
+                hook.recompute = False
+        return output, accumulator.value
+
+    def forward(self, x):
+        # ema, validation and statistic forwards keep no graph, nothing to checkpoint
+        if not torch.is_grad_enabled() or not x.requires_grad:
+            return self.stage(x)
+        output, r_feature = torch.utils.checkpoint.checkpoint(self.run, x, use_reentrant=True)
+        if self.hooks and self.hooks[0].accumulator is not None:
+            self.hooks[0].accumulator.add_(r_feature)
+        return output
+
+
+def checkpoint_teacher(model, hooks, containers=("features", "trunk_output")):
+    '''
+    wrap the conv stages of a torchvision teacher into CheckpointedStage: the top-level sequential stages
+    (resnet layer1-4, shufflenet stages) and the blocks of the features / trunk_output containers
+    (densenet, mobilenet, efficientnet, convnext, regnet); returns the number of wrapped stages
+    '''
+    def has_conv(module):
+        return any(isinstance(m, torch.nn.Conv2d) for m in module.modules())
+
+    stages = []
+    for name, child in model.named_children():
+        if name in containers and isinstance(child, torch.nn.Sequential):
+            stages += [(child, _name, _child) for _name, _child in child.named_children() if has_conv(_child)]
+        elif isinstance(child, torch.nn.Sequential) and has_conv(child):
+            stages.append((model, name, child))
+    for parent, name, stage in stages:
+        modules = set(id(m) for m in stage.modules())
+        setattr(parent, name, CheckpointedStage(stage, [hook for hook in hooks if id(hook.module) in modules]))
+    return len(stages)
+
+
 class BNFeatureHook():
     def __init__(self, module, training_momentum=0.4, flatness_weight=0.25):
+        self.module = module
         self.hook = module.register_forward_hook(self.hook_fn)
+        self.accumulator = None
+        self.recompute = False
+        # False for the micro-batches after the first, the running targets move once per iteration
+        self.update_statistics = True
+        self.loss_weight = 1.
         self.dd_var = 0.
         self.dd_mean = 0.
         self.momentum = training_momentum
@@ -131,14 +482,14 @@ class BNFeatureHook():
         self.ema_tag = True
 
     def hook_fn(self, module, input, output):
-        nch = input[0].shape[1]
-        input_0 = input[0]
-        mean = input_0.mean([0, 2, 3])
-        var = (input_0.permute(1, 0, 2, 3).contiguous().reshape([nch, -1])).var(1, unbiased=False)
+        var, mean = torch.var_mean(input[0].float(), dim=[0, 2, 3], unbiased=False)
 
         if not self.ema_tag:
+            # the recompute of a checkpointed stage sees the statistics already updated by its first pass
             with torch.no_grad():
-                if isinstance(self.dd_var, int):
+                if self.recompute or not self.update_statistics:
+                    pass
+                elif isinstance(self.dd_var, int):
                     self.dd_var = var
                     self.dd_mean = mean
                 else:
@@ -149,7 +500,10 @@ class BNFeatureHook():
             if self.flatness:
                 r_feature = r_feature + self.flatness_weight * (torch.norm(self.bn_statics_list[0] - (self.dd_var + var - var.detach()), 2) + \
                             torch.norm(self.bn_statics_list[1] - (self.dd_mean + mean - mean.detach()), 2))
-            self.r_feature = r_feature
+            if self.accumulator is not None:
+                self.accumulator.add_(r_feature, self.loss_weight)
+            else:
+                self.r_feature = r_feature
         else:
             self.bn_statics_list = [var, mean]
 
@@ -157,9 +511,236 @@ class BNFeatureHook():
         self.hook.remove()
 
 
+class StatisticStore(object):
+    '''
+    one memory-mapped file holding the ConvFeatureHook statistics of a whole backbone,
+    the json header maps every layer name to the offset and shape of its float32 arrays
+    '''
+    magic = b"CONVSTAT"
+    keys = ["running_dd_var", "running_dd_mean", "running_patch_var", "running_patch_mean"]
+
+    def __init__(self, path):
+        self.path = path
+        # copy-on-write mapping, so the arrays can be handed to torch.from_numpy without a copy
+        raw = np.memmap(path, dtype=np.uint8, mode="c")
+        if bytes(raw[:8]) != self.magic:
+            raise ValueError(f"{path} is not a statistic store")
+        header_size = int.from_bytes(bytes(raw[8:16]), "little")
+        header = json.loads(bytes(raw[16:16 + header_size]).decode())
+        self.layers = header["layers"]
+        # content key of every layer, only present in stores written with --statistic-fingerprint
+        self.fingerprints = header.get("fingerprints", {})
+        self.data = raw[16 + header_size:].view(np.float32)
+        self.device_data = {}
+
+    def __contains__(self, name):
+        return name in self.layers
+
+    def get(self, name, device=None):
+        if device is None:
+            data = torch.from_numpy(self.data)
+        else:
+            # the whole backbone is uploaded once, every layer is a view into it
+            if device not in self.device_data:
+                self.device_data[device] = torch.from_numpy(self.data).to(device)
+            data = self.device_data[device]
+        statistic = {}
+        for key, (offset, shape) in self.layers[name].items():
+            statistic[key] = data[offset:offset + int(np.prod(shape))].view(shape)
+        return statistic
+
+    @staticmethod
+    def write(path, layers, fingerprints=None):
+        header = {"layers": {}, "fingerprints": fingerprints or {}}
+        arrays = []
+        offset = 0
+        for name in sorted(layers):
+            header["layers"][name] = {}
+            for key in StatisticStore.keys:
+                array = np.ascontiguousarray(layers[name][key], dtype=np.float32)
+                header["layers"][name][key] = [offset, list(array.shape)]
+                arrays.append(array)
+                offset += array.size
+        header = json.dumps(header).encode()
+        # pad the header so that the float32 data starts on a 64 byte boundary
+        header += b" " * (-(16 + len(header)) % 64)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(StatisticStore.magic)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            for array in arrays:
+                f.write(array.tobytes())
+        os.replace(tmp_path, path)
+        _statistic_stores.pop(path, None)
+        _statistic_store_paths.pop(os.path.dirname(path), None)
+
+
+_statistic_stores = {}
+# the versioned stores of every backbone directory, newest first, scanned once per process
+_statistic_store_paths = {}
+
+
+def open_statistic_store(path):
+    if path not in _statistic_stores:
+        if not os.path.exists(path):
+            return None
+        _statistic_stores[path] = StatisticStore(path)
+    return _statistic_stores[path]
+
+
+def find_statistic_store(directory, name, fingerprint):
+    '''
+    search the versioned stores of a backbone for a layer computed under the given content key
+    '''
+    if directory not in _statistic_store_paths:
+        _statistic_store_paths[directory] = sorted(glob.glob(os.path.join(directory, "*.stat")),
+                                                   key=os.path.getmtime, reverse=True)
+    for path in _statistic_store_paths[directory]:
+        store = open_statistic_store(path)
+        if store is not None and store.fingerprints.get(name) == fingerprint:
+            return store
+    return None
+
+
+def dataset_fingerprint(dataset, transform):
+    '''
+    hash of the preprocessing and of the (relative path, label) manifest of an ImageFolder
+    '''
+    digest = hashlib.sha1(repr(transform).encode())
+    for path, target in dataset.samples:
+        digest.update(f"{os.path.relpath(path, dataset.root)}:{target}\n".encode())
+    return digest.hexdigest()
+
+
+def statistic_fingerprints(model, extra=""):
+    '''
+    content keys of the ConvFeatureHook statistics of a backbone, returns (backbone key, {conv name: layer key}).
+    The key of a layer hashes extra and the state_dict entries up to and including that layer, which covers
+    every module in front of it as long as registration order follows the forward pass (true for torchvision)
+    '''
+    digest = hashlib.sha1((model.__class__.__name__ + extra).encode())
+    prefix_digests = collections.OrderedDict()
+    for key, value in model.state_dict().items():
+        digest.update(key.encode())
+        digest.update(value.detach().cpu().float().contiguous().numpy().tobytes())
+        prefix_digests[key] = digest.hexdigest()
+    layer_keys = {}
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.Conv2d):
+            layer_keys[name] = [value for key, value in prefix_digests.items() if key.startswith(name + ".")][-1]
+    return digest.hexdigest(), layer_keys
+
+
+def save_conv_statistics(hooks):
+    '''
+    write the statistics of the given ConvFeatureHooks into the store of their backbone,
+    layers already in the store are kept
+    '''
+    layers = collections.defaultdict(dict)
+    fingerprints = collections.defaultdict(dict)
+    for hook in hooks:
+        layers[hook.store_path][hook.name] = hook.statistic()
+        if hook.fingerprint is not None:
+            fingerprints[hook.store_path][hook.name] = hook.fingerprint
+    for path, entries in layers.items():
+        store = open_statistic_store(path)
+        if store is not None:
+            for name in store.layers:
+                if name not in entries:
+                    entries[name] = {key: value.numpy() for key, value in store.get(name).items()}
+                    if name in store.fingerprints:
+                        fingerprints[path][name] = store.fingerprints[name]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        StatisticStore.write(path, entries, fingerprints[path])
+        print(f"Save the statistics of {len(entries)} layers into {path}")
+
+
+class ResumableDistributedSampler(torch.utils.data.distributed.DistributedSampler):
+    '''
+    DistributedSampler that skips the first start_index samples of its shard,
+    the permutation only depends on seed and epoch, so a restarted job sees the same order
+    '''
+
+    def __init__(self, dataset, start_index=0, **kwargs):
+        super(ResumableDistributedSampler, self).__init__(dataset, **kwargs)
+        self.start_index = start_index
+
+    def __iter__(self):
+        indices = list(super(ResumableDistributedSampler, self).__iter__())
+        return iter(indices[self.start_index:])
+
+    def __len__(self):
+        return max(self.num_samples - self.start_index, 0)
+
+
+def save_statistic_checkpoint(path, hooks, teachers, batch, world_size):
+    '''
+    save the partial sums of this rank after batch batches of the statistics pass
+    '''
+    statistic = {}
+    for hook in hooks:
+        statistic[hook.name] = {key: torch.from_numpy(value) if isinstance(value, np.ndarray) else value
+                                for key, value in hook.statistic().items()}
+        statistic[hook.name]["sample_number"] = hook.sample_number
+    state = {"teachers": teachers, "batch": batch, "world_size": world_size, "statistic": statistic}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_statistic_checkpoint(path, hooks, teachers, world_size, gpu=0):
+    '''
+    restore the partial sums of this rank, returns the number of batches already consumed
+    '''
+    if not os.path.exists(path):
+        return 0
+    state = torch.load(path, map_location="cpu")
+    if state["teachers"] != teachers or state["world_size"] != world_size:
+        print(f"Ignore the statistic checkpoint {path}, it belongs to another pass")
+        return 0
+    for hook in hooks:
+        hook.load_statistic(state["statistic"][hook.name], gpu=gpu)
+    print(f"Resume the statistics of {teachers} from batch {state['batch']}")
+    return state["batch"]
+
+
+class StatisticConvergence(object):
+    '''
+    stops the statistics pass once the running estimate of every hooked layer changed
+    by less than tolerance for patience consecutive batches, and keeps the per-layer curves
+    '''
+
+    def __init__(self, hooks, tolerance=0., patience=50):
+        self.hooks = hooks
+        self.tolerance = tolerance
+        self.patience = patience
+        self.stable_batches = np.zeros(len(hooks), dtype=np.int64)
+        self.curves = []
+        self.sample_numbers = []
+
+    def update(self):
+        # one host sync per batch for all layers
+        change = torch.stack([hook.relative_change() for hook in self.hooks]).cpu().numpy()
+        self.curves.append(change)
+        self.sample_numbers.append(self.hooks[0].sample_number)
+        self.stable_batches = np.where(change < self.tolerance, self.stable_batches + 1, 0)
+        return self.converged()
+
+    def converged(self):
+        return self.tolerance > 0 and bool((self.stable_batches >= self.patience).all())
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, layer_names=np.array([hook.name for hook in self.hooks]),
+                 sample_number=np.array(self.sample_numbers), relative_change=np.stack(self.curves, 0))
+        print(f"Save the convergence curves of {len(self.hooks)} layers into {path}")
+
+
 class ConvFeatureHook():
     def __init__(self, module=None, save_path="./", data_number=1281167, name=None, gpu=0, training_momentum=0.4,
-                 drop_rate=0.4, flatness_weight=0.25):
+                 drop_rate=0.4, flatness_weight=0.25, version=None, fingerprint=None):
 
         self.module = module
         if module is not None and name is not None:
@@ -173,24 +754,48 @@ class ConvFeatureHook():
         self.patch_mean = 0.
         self.flatness_weight = flatness_weight
         self.momentum = training_momentum  # origin = 0.2
+        self.accumulator = None
+        self.loss_weight = 1.
+        self.recompute = False
+        # False for the micro-batches after the first, the running targets move once per iteration
+        self.update_statistics = True
+        self.dropped = False
         self.drop_rate = drop_rate  # 0.0 0.4 0.8
-        dir = os.path.join(save_path, "ConvFeatureHook", name)
-        if not os.path.exists(dir):
-            os.makedirs(dir, exist_ok=True)
+        self.name = name
+        self.fingerprint = fingerprint
         self.save_path = os.path.join(save_path, "ConvFeatureHook", name, "running.npz")
-        if os.path.exists(self.save_path):
+        if version is not None:
+            # content-addressed: every backbone version gets its own store, a layer is reused from any
+            # version that computed it under the same key
+            backbone_dir = os.path.join(save_path, "ConvFeatureHook", name.split("=")[0])
+            self.store_path = os.path.join(backbone_dir, version + ".stat")
+            store = find_statistic_store(backbone_dir, name, fingerprint)
+        else:
+            # name is "<Model>=<layer>", all layers of a backbone share one consolidated store
+            self.store_path = os.path.join(save_path, "ConvFeatureHook", name.split("=")[0] + ".stat")
+            store = open_statistic_store(self.store_path)
+        if store is not None and name in store:
+            statistic = store.get(name, gpu)
+            self.load_tag = True
+            self.running_dd_var = statistic["running_dd_var"]
+            self.running_dd_mean = statistic["running_dd_mean"]
+            self.running_patch_var = statistic["running_patch_var"]
+            self.running_patch_mean = statistic["running_patch_mean"]
+        elif version is None and os.path.exists(self.save_path):
             npz_file = np.load(self.save_path)
             self.load_tag = True
-            self.running_dd_var = torch.from_numpy(npz_file["running_dd_var"]).cuda(gpu)
-            self.running_dd_mean = torch.from_numpy(npz_file["running_dd_mean"]).cuda(gpu)
-            self.running_patch_var = torch.from_numpy(npz_file["running_patch_var"]).cuda(gpu)
-            self.running_patch_mean = torch.from_numpy(npz_file["running_patch_mean"]).cuda(gpu)
+            self.running_dd_var = torch.from_numpy(npz_file["running_dd_var"]).to(gpu)
+            self.running_dd_mean = torch.from_numpy(npz_file["running_dd_mean"]).to(gpu)
+            self.running_patch_var = torch.from_numpy(npz_file["running_patch_var"]).to(gpu)
+            self.running_patch_mean = torch.from_numpy(npz_file["running_patch_mean"]).to(gpu)
         else:
             self.load_tag = False
             self.running_dd_var = 0.
             self.running_dd_mean = 0.
             self.running_patch_var = 0.
             self.running_patch_mean = 0.
+        self.sample_number = 0
+        self.last_estimate = None
         self.conv_statics_list = []
         self.ema_tag = False
         self.flatness = False
@@ -202,18 +807,72 @@ class ConvFeatureHook():
     def set_ema(self):
         self.ema_tag = True
 
+    def statistic(self):
+        return {"running_dd_var": self.running_dd_var.cpu().numpy() if isinstance(self.running_dd_var,
+                                                                                  torch.Tensor) else self.running_dd_var,
+                "running_dd_mean": self.running_dd_mean.cpu().numpy() if isinstance(self.running_dd_mean,
+                                                                                    torch.Tensor) else self.running_dd_mean,
+                "running_patch_var": self.running_patch_var.cpu().numpy() if isinstance(self.running_patch_var,
+                                                                                        torch.Tensor) else self.running_patch_var,
+                "running_patch_mean": self.running_patch_mean.cpu().numpy() if isinstance(self.running_patch_mean,
+                                                                                          torch.Tensor) else self.running_patch_mean}
+
+    def load_statistic(self, statistic, gpu=0):
+        for key in StatisticStore.keys:
+            value = statistic[key]
+            setattr(self, key, value.to(gpu) if isinstance(value, torch.Tensor) else value)
+        self.sample_number = statistic.get("sample_number", 0)
+
     def save(self):
-        npz_file = {"running_dd_var": self.running_dd_var.cpu().numpy() if isinstance(self.running_dd_var,
-                                                                                      torch.Tensor) else self.running_dd_var,
-                    "running_dd_mean": self.running_dd_mean.cpu().numpy() if isinstance(self.running_dd_mean,
-                                                                                        torch.Tensor) else self.running_dd_mean,
-                    "running_patch_var": self.running_patch_var.cpu().numpy() if isinstance(self.running_patch_var,
-                                                                                            torch.Tensor) else self.running_patch_var,
-                    "running_patch_mean": self.running_patch_mean.cpu().numpy() if isinstance(self.running_patch_mean,
-                                                                                              torch.Tensor) else self.running_patch_mean}
+        '''
+        legacy per-layer running.npz, the recover script writes the consolidated store by save_conv_statistics
+        '''
+        npz_file = self.statistic()
         print(npz_file)
+        os.makedirs(os.path.dirname(self.save_path), exist_ok=True)
         np.savez(self.save_path, **npz_file)
 
+    def all_reduce(self):
+        '''
+        merge the partial sums accumulated by pre_hook_fn on every rank
+        '''
+        if not distributed_is_initialized():
+            return
+        for key in ["running_dd_var", "running_dd_mean", "running_patch_var", "running_patch_mean"]:
+            value = getattr(self, key)
+            if isinstance(value, torch.Tensor):
+                dist.all_reduce(value, op=dist.ReduceOp.SUM)
+        if isinstance(self.running_dd_var, torch.Tensor):
+            sample_number = torch.tensor([float(self.sample_number)], device=self.running_dd_var.device)
+            dist.all_reduce(sample_number, op=dist.ReduceOp.SUM)
+            self.sample_number = int(sample_number.item())
+
+    @torch.no_grad()
+    def normalize(self):
+        '''
+        pre_hook_fn scales every batch by 1 / data_number, rescale the sums to the number of samples actually seen
+        '''
+        if self.sample_number == 0 or self.sample_number == self.data_number:
+            return
+        for key in ["running_dd_var", "running_dd_mean", "running_patch_var", "running_patch_mean"]:
+            setattr(self, key, getattr(self, key) * (self.data_number / self.sample_number))
+
+    @torch.no_grad()
+    def relative_change(self):
+        '''
+        largest relative change of the four running estimates since the last call, as a device scalar
+        '''
+        scale = self.data_number / max(self.sample_number, 1)
+        estimate = [self.running_dd_var * scale, self.running_dd_mean * scale,
+                    self.running_patch_var * scale, self.running_patch_mean * scale]
+        if self.last_estimate is None:
+            change = torch.full([], float("inf"), device=self.running_dd_var.device)
+        else:
+            change = torch.stack([torch.norm(e - l) / (torch.norm(l) + 1e-12)
+                                  for e, l in zip(estimate, self.last_estimate)]).max()
+        self.last_estimate = estimate
+        return change
+
     def set_hook(self, pre=True):
         if hasattr(self, "hook"):
             self.close()
@@ -224,38 +883,31 @@ class ConvFeatureHook():
 
     @torch.no_grad()
     def pre_hook_fn(self, module, input, output):
-        nch = input[0].shape[1]
+        if self.load_tag:
+            return
         bs = input[0].shape[0]
-        input_0 = input[0]
-        dd_mean = input_0.mean([0, 2, 3])
-        dd_var = (input_0.permute(1, 0, 2, 3).contiguous().reshape([nch, -1])).var(1, unbiased=False)
-        new_h, new_w = div_sixteen_mul(input_0.shape[2]), div_sixteen_mul(input_0.shape[3])
-        new_input_0 = F.interpolate(input_0, [new_h, new_w], mode="bilinear")
-        new_input_0 = einops.rearrange(new_input_0, "b c (u h) (v w) -> (u v) (b c h w)", h=16, w=16).contiguous()
-        patch_mean = new_input_0.mean([1])
-        patch_var = new_input_0.var([1], unbiased=False)
+        dd_mean, dd_var, patch_mean, patch_var = conv_moments(input[0])
         self.running_dd_var += (dd_var * bs / self.data_number)
         self.running_dd_mean += (dd_mean * bs / self.data_number)
         self.running_patch_var += (patch_var * bs / self.data_number)
         self.running_patch_mean += (patch_mean * bs / self.data_number)
+        self.sample_number += bs
 
     def post_hook_fn(self, module, input, output):
-        if random.random() > (1. - self.drop_rate):
-            self.r_feature = torch.Tensor([0.]).to(input[0].device)
+        # the recompute of a checkpointed stage and the later micro-batches replay the drop decision of the first pass
+        if not self.recompute and self.update_statistics:
+            self.dropped = random.random() > (1. - self.drop_rate)
+        if self.dropped:
+            if self.accumulator is None:
+                self.r_feature = torch.Tensor([0.]).to(input[0].device)
             return
-        nch = input[0].shape[1]
-        input_0 = input[0]
-        dd_mean = input_0.mean([0, 2, 3])
-        dd_var = (input_0.permute(1, 0, 2, 3).contiguous().reshape([nch, -1])).var(1, unbiased=False)
-        new_h, new_w = div_sixteen_mul(input_0.shape[2]), div_sixteen_mul(input_0.shape[3])
-        new_input_0 = F.interpolate(input_0, [new_h, new_w], mode="bilinear")
-        new_input_0 = einops.rearrange(new_input_0, "b c (u h) (v w) -> (u v) (b c h w)", h=16, w=16).contiguous()
-        patch_mean = new_input_0.mean([1])
-        patch_var = new_input_0.var([1], unbiased=False)
+        dd_mean, dd_var, patch_mean, patch_var = conv_moments(input[0])
 
         if not self.ema_tag:
             with torch.no_grad():
-                if isinstance(self.dd_var, int):
+                if self.recompute or not self.update_statistics:
+                    pass
+                elif isinstance(self.dd_var, int):
                     self.dd_var = dd_var
                     self.dd_mean = dd_mean
                     self.patch_var = patch_var
@@ -276,7 +928,10 @@ class ConvFeatureHook():
                             torch.norm(self.conv_statics_list[2] - (self.patch_mean + patch_mean - patch_mean.detach()), 2) + \
                             torch.norm(self.conv_statics_list[3] - (self.patch_var + patch_var - patch_var.detach()), 2))
 
-            self.r_feature = r_feature
+            if self.accumulator is not None:
+                self.accumulator.add_(r_feature, self.loss_weight)
+            else:
+                self.r_feature = r_feature
         else:
             self.conv_statics_list = [dd_var, dd_mean, patch_mean, patch_var]
 
@@ -302,6 +957,355 @@ class GatherLayer(torch.autograd.Function):
         return grad_out
 
 
+class SynthesisStep(object):
+    '''
+    one global batch of the recover loop: the turn_index entries every rank optimizes,
+    and whether the nuclear-norm term has to all_gather because a class spans ranks;
+    every rank runs the collectives of a step, so all of them get a non-empty slice of the same length,
+    the last padding[rank] entries of a slice repeat entries of the step and are not saved
+    '''
+    def __init__(self, rank_indices, gather, task_id=None, padding=None):
+        lengths = set(len(indices) for indices in rank_indices)
+        if len(lengths) != 1 or 0 in lengths:
+            raise ValueError(f"every rank needs a non-empty slice of the same length, got {sorted(lengths)}")
+        self.rank_indices = rank_indices
+        self.gather = gather
+        self.task_id = task_id
+        self.padding = padding if padding is not None else [0] * len(rank_indices)
+
+    @property
+    def indices(self):
+        return torch.cat(self.rank_indices)
+
+
+def interleaved_schedule(turn_index, world_size, batch_size):
+    '''
+    the original schedule, consecutive sub-batches of turn_index per rank and an all_gather on every step;
+    a last partial step is spread evenly over the ranks and padded by repeating its own entries
+    '''
+    sub_batch_size = batch_size // world_size
+    step_size = sub_batch_size * world_size
+    total_number = len(turn_index)
+    steps = []
+    for zz in range(0, total_number - total_number % step_size, step_size):
+        rank_indices = [turn_index[zz + rank * sub_batch_size:zz + (rank + 1) * sub_batch_size]
+                        for rank in range(world_size)]
+        steps.append(SynthesisStep(rank_indices, gather=True))
+    remainder = turn_index[total_number - total_number % step_size:]
+    if len(remainder) > 0:
+        length = -(-len(remainder) // world_size)
+        padded = remainder[torch.arange(length * world_size) % len(remainder)]
+        rank_indices = [padded[rank * length:(rank + 1) * length] for rank in range(world_size)]
+        padding = [min(max((rank + 1) * length - len(remainder), 0), length) for rank in range(world_size)]
+        steps.append(SynthesisStep(rank_indices, gather=True, padding=padding))
+    return steps
+
+
+def class_affine_schedule(turn_index, targets, world_size, batch_size):
+    '''
+    packs whole class groups onto single ranks, so the nuclear-norm term is local and needs no all_gather;
+    a step takes the same number of equally sized classes on every rank, so the slices have the same length.
+    classes larger than a sub-batch and the last classes that can not fill every rank follow in interleaved
+    steps that gather
+    '''
+    sub_batch_size = batch_size // world_size
+    groups = collections.OrderedDict()
+    for index in turn_index.tolist():
+        groups.setdefault(int(targets[index]), []).append(index)
+
+    steps = []
+    spanning = []
+    same_size = collections.OrderedDict()
+    for group in groups.values():
+        if len(group) > sub_batch_size:
+            spanning.extend(group)
+        else:
+            same_size.setdefault(len(group), []).append(group)
+    for size, same_groups in same_size.items():
+        while len(same_groups) >= world_size:
+            per_rank = min(sub_batch_size // size, len(same_groups) // world_size)
+            rank_indices = [torch.LongTensor([index for group in same_groups[rank * per_rank:(rank + 1) * per_rank]
+                                              for index in group]) for rank in range(world_size)]
+            steps.append(SynthesisStep(rank_indices, gather=False))
+            same_groups = same_groups[world_size * per_rank:]
+        spanning.extend(index for group in same_groups for index in group)
+    if spanning:
+        if not steps:
+            print("every class is larger than a sub-batch, the class-affine schedule is the interleaved one")
+        steps += interleaved_schedule(torch.LongTensor(spanning), world_size, batch_size)
+    return steps
+
+
+def queue_schedule(queue, worker, pair_index):
+    '''
+    the steps of one worker in work-queue mode, tasks are claimed until the queue is drained
+    '''
+    while True:
+        task = queue.claim(worker)
+        if task is None:
+            return
+        task_id, pairs = task
+        indices = torch.LongTensor([pair_index(class_id, ipc_id) for class_id, ipc_id in pairs])
+        yield SynthesisStep([indices], gather=False, task_id=task_id)
+
+
+class SynthesisQueue(object):
+    '''
+    sqlite-backed queue of synthesis batches, every task is a list of (class, ipc_id) pairs;
+    workers claim pending tasks, a running task whose heartbeat is older than stale_after is handed out again,
+    up to max_attempts claims, after that it is marked failed. sqlite locking is only reliable on a local disk,
+    so all workers of a queue have to run on the node that holds the file
+    '''
+    def __init__(self, path, stale_after=3600., max_attempts=3):
+        self.path = path
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=600., isolation_level=None)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, pairs TEXT NOT NULL, "
+                                "status TEXT NOT NULL DEFAULT 'pending', worker TEXT, heartbeat REAL, "
+                                "attempts INTEGER NOT NULL DEFAULT 0)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def bind_ipc_range(self, ipc_range):
+        '''
+        the ipc ids the queue was created for, the pairs of its tasks map to turn_index positions relative to them;
+        the first worker records its range, the ones joining later get the recorded one back
+        '''
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'ipc_range'").fetchone()
+            if row is not None:
+                return list(range(*json.loads(row[0])))
+            if len(ipc_range) > 0:
+                self.connection.execute("INSERT INTO meta (key, value) VALUES ('ipc_range', ?)",
+                                        (json.dumps([ipc_range[0], ipc_range[-1] + 1]),))
+        return list(ipc_range)
+
+    def populate(self, tasks):
+        # the first worker fills the queue, the ones joining later find it populated
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            if self.connection.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] == 0:
+                self.connection.executemany("INSERT INTO tasks (pairs) VALUES (?)",
+                                            [(json.dumps(pairs),) for pairs in tasks])
+
+    def claim(self, worker):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            # a task that keeps killing its workers is not handed out again
+            failed = self.connection.execute(
+                "UPDATE tasks SET status = 'failed' WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                (time.time() - self.stale_after, self.max_attempts)).rowcount
+            if failed > 0:
+                print(f"{failed} tasks failed after {self.max_attempts} attempts")
+            row = self.connection.execute(
+                "SELECT id, pairs FROM tasks WHERE status = 'pending' OR (status = 'running' AND heartbeat < ?) "
+                "ORDER BY id LIMIT 1", (time.time() - self.stale_after,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE tasks SET status = 'running', worker = ?, heartbeat = ?, "
+                                    "attempts = attempts + 1 WHERE id = ?", (worker, time.time(), row[0]))
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, task_id):
+        self.connection.execute("UPDATE tasks SET heartbeat = ? WHERE id = ?", (time.time(), task_id))
+
+    def complete(self, task_id):
+        self.connection.execute("UPDATE tasks SET status = 'done', heartbeat = ? WHERE id = ?", (time.time(), task_id))
+
+    def progress(self):
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+
+    def close(self):
+        self.connection.close()
+
+
+class SynthesisManifest(object):
+    '''
+    completed (class, ipc_id) pairs of a recover run, one append-only jsonl file per worker,
+    all files are read on start so that a restarted run skips what is already on disk
+    '''
+    def __init__(self, directory, worker):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{worker}.jsonl")
+        self.done = set()
+        for path in glob.glob(os.path.join(directory, "*.jsonl")):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line of a worker killed while writing
+                        continue
+                    self.done.add((record["class"], record["ipc_id"]))
+
+    def __contains__(self, pair):
+        return pair in self.done
+
+    def complete(self, pairs):
+        with open(self.path, "a") as f:
+            for class_id, ipc_id in pairs:
+                f.write(json.dumps({"class": class_id, "ipc_id": ipc_id}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(pairs)
+
+
+def pairs_digest(pairs):
+    '''
+    short stable name of a batch of (class, ipc_id) pairs
+    '''
+    return hashlib.md5(json.dumps([list(pair) for pair in pairs]).encode()).hexdigest()[:16]
+
+
+class ImageWriter(object):
+    '''
+    background jpeg writer of synthesized batches: one bulk uint8 device-to-host copy per batch, encoding and
+    writes on a thread pool, write() blocks while max_pending batches are in flight; the on_done callback of a
+    batch runs on the calling thread once all of its images are on disk, e.g. to update the manifest
+    '''
+    def __init__(self, threads=8, max_pending=4):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.pending = collections.deque()
+        self.max_pending = max_pending
+        self.directories = set()
+
+    def write(self, images, paths, on_done=None):
+        # images in [0, 1], same truncation as (image_np * 255).astype(np.uint8)
+        images = (images.detach() * 255).to(torch.uint8).permute(0, 2, 3, 1).contiguous().cpu().numpy()
+        while len(self.pending) >= self.max_pending:
+            self._finish_oldest()
+        futures = [self.pool.submit(self._save, image, path) for image, path in zip(images, paths)]
+        self.pending.append((futures, on_done))
+        self.poll()
+
+    def write_shard(self, images, root, labels, ipc_ids, classes, on_done=None):
+        '''
+        the whole batch as one lossless packed shard, named after its (class, ipc_id) pairs so a rerun replaces it
+        '''
+        images = (images.detach() * 255).to(torch.uint8).permute(0, 2, 3, 1).contiguous().cpu().numpy()
+        while len(self.pending) >= self.max_pending:
+            self._finish_oldest()
+        name = pairs_digest(list(zip(labels, ipc_ids)))
+        futures = [self.pool.submit(write_packed_shard, root, name, images, labels, ipc_ids, classes)]
+        self.pending.append((futures, on_done))
+        self.poll()
+
+    def _save(self, image, path):
+        directory = os.path.dirname(path)
+        if directory not in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+        Image.fromarray(image).save(path)
+
+    def poll(self):
+        # callbacks run in submission order
+        while self.pending and all(future.done() for future in self.pending[0][0]):
+            self._finish_oldest()
+
+    def _finish_oldest(self):
+        futures, on_done = self.pending.popleft()
+        for future in futures:
+            future.result()
+        if on_done is not None:
+            on_done()
+
+    def flush(self):
+        while self.pending:
+            self._finish_oldest()
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
+
+
+# the running targets of the feature hooks and the EMA-branch statistics kept next to the cached EMA logits
+HOOK_STATE_KEYS = ["dd_var", "dd_mean", "patch_var", "patch_mean", "bn_statics_list", "conv_statics_list"]
+
+
+def _move(value, device):
+    if isinstance(value, torch.Tensor):
+        return value.detach().to(device)
+    if isinstance(value, (list, tuple)):
+        return [_move(v, device) for v in value]
+    return value
+
+
+def rng_state():
+    state = {"torch": torch.get_rng_state(), "python": random.getstate(), "numpy": np.random.get_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    if torch.cuda.is_available() and "cuda" in state:
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+def save_synthesis_snapshot(path, pairs, iteration, counter, inputs, optimizer, ema_bank, hooks=(),
+                            ema_refresh=None, scaler=None):
+    '''
+    mid-batch state of the recover loop, written to a temporary file and renamed, so a crash keeps the previous one;
+    ema_bank is None when no loss term reads the EMA tracks, hooks are the feature hooks of every teacher and
+    ema_refresh the visits and cached logits of the EMA refresh; with the RNG states a resumed batch
+    takes the same next step as an uninterrupted one
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    state = {"pairs": pairs, "iteration": iteration, "counter": counter, "inputs": inputs.detach().cpu(),
+             "optimizer": optimizer.state_dict(),
+             "ema_bank": ema_bank.state_dict() if ema_bank is not None else None,
+             "hooks": [{key: _move(getattr(hook, key), "cpu") for key in HOOK_STATE_KEYS if hasattr(hook, key)}
+                       for hook in hooks],
+             "ema_refresh": {key: _move(value, "cpu") for key, value in ema_refresh.items()}
+             if ema_refresh is not None else None,
+             # a disabled scaler has no state, and refuses to load an empty one
+             "scaler": scaler.state_dict() if scaler is not None and scaler.is_enabled() else None,
+             "rng": rng_state()}
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def load_synthesis_snapshot(path, pairs):
+    '''
+    the snapshot of the batch made of these (class, ipc_id) pairs, None if there is none or it belongs to another batch
+    '''
+    if not os.path.exists(path):
+        return None
+    state = torch.load(path, map_location="cpu")
+    if [tuple(pair) for pair in state["pairs"]] != [tuple(pair) for pair in pairs]:
+        return None
+    return state
+
+
+def restore_synthesis_snapshot(state, inputs, optimizer, ema_bank, hooks=(), scaler=None):
+    '''
+    puts the snapshot back in place, returns the iteration, the counter and the EMA refresh state (None in
+    snapshots written without it, the refresh then starts over)
+    '''
+    with torch.no_grad():
+        inputs.copy_(state["inputs"])
+    optimizer.load_state_dict(state["optimizer"])
+    if ema_bank is not None and state["ema_bank"] is not None:
+        ema_bank.load_state_dict(state["ema_bank"])
+    for hook, hook_state in zip(hooks, state.get("hooks", [])):
+        for key, value in hook_state.items():
+            setattr(hook, key, _move(value, inputs.device))
+    if scaler is not None and state.get("scaler") is not None:
+        scaler.load_state_dict(state["scaler"])
+    if "rng" in state:
+        set_rng_state(state["rng"])
+    ema_refresh = state.get("ema_refresh")
+    if ema_refresh is not None:
+        ema_refresh = {key: _move(value, inputs.device) for key, value in ema_refresh.items()}
+    return state["iteration"], state["counter"], ema_refresh
+
+
 def get_image_prior_losses(inputs_jit):
     diff1 = inputs_jit[:, :, :, :-1] - inputs_jit[:, :, :, 1:]
     diff2 = inputs_jit[:, :, :-1, :] - inputs_jit[:, :, 1:, :]
@@ -329,6 +1333,44 @@ class PreImgPathCache(ImageFolder):
         self.label2img = [[] for _ in range(len(self.classes))]
         for k, v in self.imgs:
             self.label2img[v].append(k)
+        self.label2array = None
+        self.pool = None
+
+    def decode(self, size=224, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), threads=8):
+        '''
+        decode and resize every image once into one uint8 (n, 3, size, size) tensor per class,
+        sample_batch then only indexes, flips and normalizes
+        '''
+        def load(path):
+            image = self.loader(path).resize((size, size), Image.BILINEAR)
+            return torch.from_numpy(np.array(image, dtype=np.uint8)).permute(2, 0, 1)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+            self.label2array = [torch.stack(list(pool.map(load, imgpaths)), 0) if imgpaths else None
+                                for imgpaths in self.label2img]
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        print(f"Decoded {len(self.imgs)} initial images into "
+              f"{sum(a.numel() for a in self.label2array if a is not None) / 2 ** 30:.2f} GiB")
+
+    def sample_batch(self, targets, device="cpu"):
+        if self.label2array is None:
+            return torch.stack([self.random_img_sample(_target) for _target in targets], 0).to(device)
+        images = torch.stack([self.label2array[_target][np.random.randint(len(self.label2array[_target]))]
+                              for _target in targets], 0)
+        images = images.to(device).float().div_(255)
+        # RandomHorizontalFlip of every image
+        flip = (torch.rand(images.shape[0], device=images.device) < 0.5).view(-1, 1, 1, 1)
+        images = torch.where(flip, images.flip(3), images)
+        return (images - self.mean.to(images.device)) / self.std.to(images.device)
+
+    def prefetch(self, targets, threads=2):
+        '''
+        sample_batch on a background thread, e.g. for the next batch while the current one is optimized
+        '''
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        return self.pool.submit(self.sample_batch, targets)
 
     def random_img_sample(self,idx):
         imgpaths = self.label2img[idx]
@@ -0,0 +1,62 @@
+'''Convert a distilled jpeg tree (newXXX/classXXX_idYYY.jpg) into packed uint8 shards read by PackedImageFolder'''
+
+import os
+import re
+import argparse
+
+import numpy as np
+import torchvision
+from PIL import Image
+
+from utils_fkd import write_packed_shard, PackedImageFolder
+
+"""
+python pack_dataset.py --data ../recover/syn_data/CSDC_b5_ImageNet_1k_Recover_IPC_10 \
+    --output ../recover/syn_data/CSDC_b5_ImageNet_1k_Recover_IPC_10_packed
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser("Pack a distilled jpeg tree into uint8 shards")
+    parser.add_argument('--data', type=str, required=True, help='the ImageFolder tree of the distilled images')
+    parser.add_argument('--output', type=str, required=True, help='directory of the packed shards')
+    parser.add_argument('--shard-size', type=int, default=1000, help='images per shard')
+    parser.add_argument('--resolution', type=int, default=0,
+                        help='resize every image to this square resolution, 0 requires all images to share one size')
+    parser.add_argument('--verify', action='store_true', default=False,
+                        help='read the shards back and compare them with the decoded jpegs')
+    args = parser.parse_args()
+
+    dataset = torchvision.datasets.ImageFolder(args.data)
+    # ipc id from the file name, otherwise the position within the class keeps the ImageFolder order
+    ipc_ids, position = [], {}
+    for path, target in dataset.samples:
+        match = re.search(r"_id(\d+)\.", os.path.basename(path))
+        position[target] = position.get(target, -1) + 1
+        ipc_ids.append(int(match.group(1)) if match else position[target])
+
+    def load(path):
+        image = dataset.loader(path)
+        if args.resolution > 0 and image.size != (args.resolution, args.resolution):
+            image = image.resize((args.resolution, args.resolution), Image.BILINEAR)
+        return np.asarray(image, dtype=np.uint8)
+
+    for begin in range(0, len(dataset.samples), args.shard_size):
+        samples = dataset.samples[begin:begin + args.shard_size]
+        images = [load(path) for path, _ in samples]
+        if len(set(image.shape for image in images)) > 1:
+            raise ValueError(f"images of different sizes in {args.data}, pass --resolution")
+        write_packed_shard(args.output, "{:06d}".format(begin // args.shard_size), np.stack(images, 0),
+                           [target for _, target in samples], ipc_ids[begin:begin + args.shard_size], dataset.classes)
+    print(f"packed {len(dataset.samples)} images of {len(dataset.classes)} classes into {args.output}")
+
+    if args.verify:
+        packed = PackedImageFolder(args.output)
+        assert packed.classes == dataset.classes and packed.targets == dataset.targets, "order mismatch"
+        for i, (path, _) in enumerate(dataset.samples):
+            assert np.array_equal(np.asarray(packed.loader(i)), load(path)), f"pixel mismatch at {path}"
+        print("verified")
+
+
+if __name__ == '__main__':
+    main()
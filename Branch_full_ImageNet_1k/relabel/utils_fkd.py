@@ -1,9 +1,11 @@
 import os
+import glob
 import torch,random
 import torch.distributed
 import torchvision
 from torchvision.transforms import functional as t_F
 import numpy as np
+from PIL import Image
 
 
 class RandomResizedCropWithCoords(torchvision.transforms.RandomResizedCrop):
@@ -158,11 +160,115 @@ def get_FKD_info(fkd_path):
     return max_epoch, batch_size, num_img
 
 
-class ImageFolder_FKD_MIX(torchvision.datasets.ImageFolder):
+def is_packed_folder(root):
+    return root is not None and len(glob.glob(os.path.join(root, "shard_*.npz"))) > 0
+
+
+def write_packed_shard(root, name, images, labels, ipc_ids, classes):
+    '''
+    one shard of a packed distilled dataset: shard_<name>.npy holds the (N, H, W, 3) uint8 images and
+    shard_<name>.npz their labels, ipc ids and the class names; both are renamed into place, the index last
+    '''
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, "shard_" + name)
+    with open(path + ".npy.tmp", "wb") as f:
+        np.save(f, np.ascontiguousarray(images, dtype=np.uint8))
+    with open(path + ".npz.tmp", "wb") as f:
+        np.savez(f, label=np.asarray(labels, dtype=np.int64), ipc_id=np.asarray(ipc_ids, dtype=np.int64),
+                 classes=np.array(classes))
+    os.replace(path + ".npy.tmp", path + ".npy")
+    os.replace(path + ".npz.tmp", path + ".npz")
+
+
+def packed_pairs(root):
+    '''
+    the (label, ipc_id) pairs stored in the shards of a packed folder
+    '''
+    pairs = set()
+    for index_path in glob.glob(os.path.join(root, "shard_*.npz")):
+        index = np.load(index_path)
+        pairs.update(zip(index["label"].tolist(), index["ipc_id"].tolist()))
+    return pairs
+
+
+class PackedImageLoader(object):
+    '''
+    loader of a packed folder, maps a sample index to the PIL image; the shards are memory-mapped on first use,
+    so every dataloader worker opens its own maps
+    '''
+    def __init__(self, root):
+        self.root = root
+        entries = {}
+        # a pair written by several runs is taken from the newest shard
+        for index_path in sorted(glob.glob(os.path.join(root, "shard_*.npz")), key=os.path.getmtime):
+            index = np.load(index_path)
+            self.classes = index["classes"].tolist()
+            shard = os.path.basename(index_path)[:-len(".npz")]
+            for offset, (label, ipc_id) in enumerate(zip(index["label"].tolist(), index["ipc_id"].tolist())):
+                entries[(label, ipc_id)] = (shard, offset)
+        # the order of ImageFolder on classXXX_idYYY.jpg files: by class, then by ipc id
+        self.keys = sorted(entries)
+        self.locations = [entries[key] for key in self.keys]
+        self.shards = {}
+
+    def __call__(self, index):
+        shard, offset = self.locations[index]
+        if shard not in self.shards:
+            self.shards[shard] = np.load(os.path.join(self.root, shard + ".npy"), mmap_mode="r")
+        return Image.fromarray(np.array(self.shards[shard][offset]))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        return state
+
+
+class PackedFolderMixin(object):
+    '''
+    the ImageFolder attributes of a packed folder: samples are (index, target) and the loader reads the index
+    from the shards, classes / class_to_idx / targets as for the jpeg tree
+    '''
+    def _init_packed(self, root):
+        self.loader = PackedImageLoader(root)
+        self.classes = self.loader.classes
+        self.class_to_idx = {name: i for i, name in enumerate(self.classes)}
+        self.samples = [(i, label) for i, (label, _) in enumerate(self.loader.keys)]
+        self.targets = [s[1] for s in self.samples]
+        self.imgs = self.samples
+
+
+class PackedImageFolder(PackedFolderMixin, torchvision.datasets.VisionDataset):
+    '''
+    drop-in for ImageFolder on a packed folder
+    '''
+    def __init__(self, root, transform=None, target_transform=None, **kwargs):
+        torchvision.datasets.VisionDataset.__init__(self, root, transform=transform, target_transform=target_transform)
+        self._init_packed(root)
+
+    def __getitem__(self, index):
+        path, target = self.samples[index]
+        sample = self.loader(path)
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class ImageFolder_FKD_MIX(PackedFolderMixin, torchvision.datasets.ImageFolder):
     def __init__(self, fkd_path, mode, args_epoch=None, args_bs=None, seed=42, **kwargs):
         self.fkd_path = fkd_path
         self.mode = mode
-        super(ImageFolder_FKD_MIX, self).__init__(**kwargs)
+        if is_packed_folder(kwargs.get("root")):
+            # packed shards instead of the jpeg tree, the same samples / loader interface
+            torchvision.datasets.VisionDataset.__init__(self, kwargs["root"], transform=kwargs.get("transform"),
+                                                        target_transform=kwargs.get("target_transform"))
+            self._init_packed(kwargs["root"])
+        else:
+            super(ImageFolder_FKD_MIX, self).__init__(**kwargs)
         self.batch_config = None  # [list(coords), list(flip_status)]
         self.batch_config_idx = 0  # index of processing image in this batch
         self.config_list = None